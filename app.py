@@ -1,24 +1,49 @@
 import os
+import signal
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 from src import log
-from src.handler import CompeChatHandler
-import configparser
-
-inifile = configparser.ConfigParser()
-inifile.read('./config.ini', 'UTF-8')
+from src.handler import CompeChatHandler, ReadyHandler
+from src.admin import CpuProfileHandler, MemoryProfileHandler, ObjectStatsHandler, AnnounceHandler
+from src.cache import WarmupManager
+from src.manager import ShutdownManager
+from src.trace import Tracer
+from src.capture import CaptureManager
+from src.config import inifile
 
 def main():
     log.setting()
+    Tracer.setting()
+    CaptureManager.setting()
     app = tornado.web.Application(
         [
             ('/CompeChat', CompeChatHandler),
+            ('/ready', ReadyHandler),
+            ('/admin/profile/cpu', CpuProfileHandler),
+            ('/admin/profile/memory', MemoryProfileHandler),
+            ('/admin/stats', ObjectStatsHandler),
+            ('/admin/announce', AnnounceHandler),
             (r'/(.*)', tornado.web.StaticFileHandler, {'path': os.path.join(os.path.dirname(__file__), "static")}),
         ])
     server = tornado.httpserver.HTTPServer(app)
-    server.listen(inifile.get('settings', 'port'))
+    # SO_REUSEPORTを使用する場合、停止中の旧プロセスと起動した新プロセスが同じポートで並行して待ち受けられる。
+    sockets = tornado.netutil.bind_sockets(inifile.getint('settings', 'port'), reuse_port=inifile.getboolean('settings', 'reusePort'))
+    server.add_sockets(sockets)
+    ShutdownManager.setting(
+            server,
+            inifile.getint('drain', 'reconnectDelayMin'),
+            inifile.getint('drain', 'reconnectDelayMax'),
+            inifile.getint('drain', 'timeout')
+            )
+    signal.signal(signal.SIGINT, ShutdownManager.onSignal)
+    signal.signal(signal.SIGTERM, ShutdownManager.onSignal)
+    # コネクションプール生成、キャッシュ読込(完了は/readyで確認できる。)
+    tornado.ioloop.IOLoop.instance().spawn_callback(WarmupManager.start)
     tornado.ioloop.IOLoop.instance().start()
+    # 停止処理(ShutdownManager.drain)の完了後
+    CaptureManager.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,320 @@
+#coding: UTF-8
+
+import collections
+import cProfile
+import gc
+import hmac
+import json
+import marshal
+import math
+import os
+import pickle
+import sys
+import threading
+import time
+import tracemalloc
+import tornado.gen
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+from src import log
+from src.config import inifile
+from src.enums import ResultStatus, SendType
+from src.util import ValueUtils
+from src.manager import SessionManager, SessionInfo
+from src.cache import MessageCache, StampCache
+from src.repository import RepositoryFactory, RepositoryException, SendMessageData
+from src.service import PushMessage
+from src.search import SearchIndexManager
+
+class AdminHandlerBase(tornado.web.RequestHandler):
+    """
+    管理用APIの基底クラス
+    [admin] tokenが未設定の場合は無効(404)とし、
+    X-Admin-Tokenヘッダが一致しない場合は403とする。(アクセスログに残らないよう、URLのパラメータでは受け付けない。)
+    """
+    logger = log.getLog(__name__)
+    token = inifile.get('admin', 'token', fallback='')
+
+    def prepare(self):
+        if not AdminHandlerBase.token:
+            raise tornado.web.HTTPError(404)
+        token = self.request.headers.get("X-Admin-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), AdminHandlerBase.token.encode("utf-8")):
+            if log.isWarning():
+                self.logger.warning("管理用APIの認証エラー:" + self.request.remote_ip + " " + self.request.path)
+            raise tornado.web.HTTPError(403)
+
+    def getIntArgument(self, name: str, default: int, minValue: int = 0) -> int:
+        """
+        数値のパラメータを取得する。(数値でない場合は400、minValue未満の場合はminValueとする。)
+        """
+        try:
+            value = int(self.get_argument(name, str(default)))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        return max(value, minValue)
+
+    def writeFile(self, data: bytes, fileName: str, contentType: str = "application/octet-stream"):
+        self.set_header("Content-Type", contentType)
+        self.set_header("Content-Disposition", "attachment; filename=" + fileName)
+        self.write(data)
+
+class ProfileManager():
+    """
+    稼働中のプロセスのプロファイル取得
+    同時に取得できるのは1件のみとする。(取得時間はmaxSeconds以内)
+    """
+    logger = log.getLog(__name__)
+    maxSeconds = inifile.getint('admin', 'profileMaxSeconds', fallback=60)
+    sampleInterval = inifile.getfloat('admin', 'sampleIntervalMs', fallback=5) / 1000
+    isRunning = False
+
+    @staticmethod
+    def getSeconds(handler: tornado.web.RequestHandler) -> float:
+        try:
+            seconds = float(handler.get_argument("seconds", "10"))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not math.isfinite(seconds):
+            raise tornado.web.HTTPError(400)
+        return min(max(seconds, 0.1), ProfileManager.maxSeconds)
+
+    @staticmethod
+    def begin():
+        if ProfileManager.isRunning:
+            raise tornado.web.HTTPError(409)
+        ProfileManager.isRunning = True
+
+    @staticmethod
+    def end():
+        ProfileManager.isRunning = False
+
+    @staticmethod
+    def sampleStacks(seconds: float) -> dict:
+        """
+        全スレッドのスタックを一定間隔で採取し、呼出経路毎の採取数(collapsed stacks)を返す。
+        (IOLoopとは別スレッドで実行する。)
+        """
+        counts = collections.Counter()
+        selfId = threading.get_ident()
+        threadNames = dict()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                threadNames[thread.ident] = thread.name
+            for threadId, frame in sys._current_frames().items():
+                if threadId == selfId:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                stack.append(threadNames.get(threadId, str(threadId)))
+                stack.reverse()
+                counts[";".join(stack)] += 1
+            time.sleep(ProfileManager.sampleInterval)
+        return counts
+
+class CpuProfileHandler(AdminHandlerBase):
+    """
+    CPUプロファイル
+    format=collapsed(既定): 全スレッドのサンプリング結果(flamegraph.pl、speedscopeで表示できる。)
+    format=pstats: IOLoopのスレッドのcProfile結果(pstats.Statsで読み込める。)
+    """
+    async def get(self):
+        seconds = ProfileManager.getSeconds(self)
+        profileFormat = self.get_argument("format", "collapsed")
+        if profileFormat not in ("collapsed", "pstats"):
+            raise tornado.web.HTTPError(400)
+        ProfileManager.begin()
+        try:
+            if log.isInfo():
+                self.logger.info("CPUプロファイル開始 format:" + profileFormat + ", seconds:" + str(seconds))
+            if profileFormat == "pstats":
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await tornado.gen.sleep(seconds)
+                finally:
+                    profiler.disable()
+                profiler.create_stats()
+                self.writeFile(marshal.dumps(profiler.stats), "profile.pstats")
+            else:
+                counts = await tornado.ioloop.IOLoop.current().run_in_executor(None, ProfileManager.sampleStacks, seconds)
+                lines = [stack + " " + str(count) for stack, count in sorted(counts.items())]
+                self.writeFile(("\n".join(lines) + "\n").encode("utf-8"), "profile.collapsed", "text/plain; charset=UTF-8")
+        finally:
+            ProfileManager.end()
+
+class MemoryProfileHandler(AdminHandlerBase):
+    """
+    メモリプロファイル(tracemalloc)
+    seconds間の割り当てを追跡し、スナップショットを取得する。(既に追跡中の場合は即時に取得する。)
+    format=text(既定): 割り当て元の行毎の上位limit件
+    format=snapshot: tracemalloc.Snapshot.loadで読み込めるファイル
+    """
+    async def get(self):
+        seconds = ProfileManager.getSeconds(self)
+        profileFormat = self.get_argument("format", "text")
+        if profileFormat not in ("text", "snapshot"):
+            raise tornado.web.HTTPError(400)
+        limit = self.getIntArgument("limit", 50)
+        frames = self.getIntArgument("frames", 1, 1)
+        ProfileManager.begin()
+        isStarted = False
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                isStarted = True
+                if log.isInfo():
+                    self.logger.info("メモリプロファイル開始 seconds:" + str(seconds))
+                await tornado.gen.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if isStarted:
+                tracemalloc.stop()
+            ProfileManager.end()
+        if profileFormat == "snapshot":
+            self.writeFile(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL), "memory.snapshot")
+            return
+        stats = snapshot.statistics("lineno")
+        lines = ["total: " + str(sum(stat.size for stat in stats)) + " bytes, " + str(sum(stat.count for stat in stats)) + " blocks"]
+        lines.extend(str(stat) for stat in stats[:limit])
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.write("\n".join(lines) + "\n")
+
+class ObjectStatsHandler(AdminHandlerBase):
+    """
+    稼働状況(セッション数、接続数、キャッシュしているメッセージ数)
+    objects=Nを指定した場合は、GC管理下のオブジェクト数の上位N件の型も返す。
+    """
+    def get(self):
+        stats = {
+            "sessions": SessionManager.countSessions(),
+            "connections": SessionManager.countConnections(),
+            "cached_messages": MessageCache.countMessages(),
+            "indexed_messages": SearchIndexManager.countMessages(),
+            "pid": os.getpid()
+            }
+        objects = self.getIntArgument("objects", 0)
+        if objects > 0:
+            counts = collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+            stats["live_session_infos"] = counts.get(SessionInfo.__name__, 0)
+            stats["live_handlers"] = counts.get("CompeChatHandler", 0)
+            stats["objects"] = dict(counts.most_common(objects))
+        self.write(stats)
+
+class AnnounceHandler(AdminHandlerBase):
+    """
+    お知らせの一括送信
+    POST(json): {"compe_nos": [コンペ番号], "message": 本文, "stamp_id": スタンプID, "send_type": 1(全員)あるいは2(コンペ参加者), "member_id": 送信者}
+    全コンペ分のメッセージを1回のトランザクションで登録し、コンペ毎に1回だけ変換した通知を配信する。
+    配信はchunkSize件毎にIOLoopへ処理を戻し、他の送受信を止めないようにする。
+    """
+    chunkSize = max(1, inifile.getint('admin', 'announceChunkSize', fallback=500))
+    maxCompes = inifile.getint('admin', 'announceMaxCompes', fallback=1000)
+    memberId = inifile.get('admin', 'announceMemberId', fallback='system')
+
+    def writeError(self, httpStatus: int, status: ResultStatus, message: str = None):
+        self.set_status(httpStatus)
+        result = { "status": status.value }
+        if message is not None:
+            result["error"] = message
+        self.write(result)
+
+    def parseForm(self) -> tuple:
+        """
+        リクエストを検証し、(コンペ番号一覧, 送信タイプ, 登録するメッセージ一覧)を返す。(不正な場合はエラーメッセージ)
+        """
+        try:
+            form = json.loads(self.request.body)
+        except ValueError:
+            return "jsonを指定してください。"
+        if not isinstance(form, dict):
+            return "jsonを指定してください。"
+        compeNos = form.get("compe_nos")
+        if not isinstance(compeNos, list) or len(compeNos) == 0:
+            return "compe_nosは必須です。"
+        if len(compeNos) > AnnounceHandler.maxCompes:
+            return "compe_nosは" + str(AnnounceHandler.maxCompes) + "件以内で指定してください。"
+        if not all(ValueUtils.isNumeric(compeNo) for compeNo in compeNos):
+            return "compe_nosは数値を設定してください。"
+        message = ValueUtils.getStr(form, "message")
+        stampId = ValueUtils.getStr(form, "stamp_id")
+        if ValueUtils.isEmpty(message) and ValueUtils.isEmpty(stampId):
+            return "messageとstamp_idのいずれかが必須です。"
+        sendType = form.get("send_type")
+        if sendType is None:
+            sendType = SendType.All
+        elif ValueUtils.isNumeric(sendType):
+            sendType = SendType.parse(ValueUtils.toInt(sendType))
+        if sendType not in (SendType.All, SendType.Compe):
+            return "send_typeは1(全員)あるいは2(コンペ参加者)を設定してください。"
+        memberId = ValueUtils.getStr(form, "member_id") or AnnounceHandler.memberId
+        now = ValueUtils.getTimeInMillis()
+        # 重複を除く(指定順)
+        compeNos = list(dict.fromkeys(ValueUtils.toInt(compeNo) for compeNo in compeNos))
+        datas = [SendMessageData(None, sendType.value, compeNo, None, memberId, now, message, stampId, False) for compeNo in compeNos]
+        return (sendType, datas)
+
+    @staticmethod
+    def save(datas: list):
+        """
+        メッセージの一括登録(IOLoopとは別スレッドで実行する。)
+        """
+        with RepositoryFactory.createMessageDat() as messageDat:
+            messageDat.saveAll(datas)
+        for data in datas:
+            MessageCache.add(data)
+            SearchIndexManager.add(data)
+        return StampCache.findStamp(datas[0].stamp_id)
+
+    async def post(self):
+        started = time.monotonic()
+        parsed = self.parseForm()
+        if isinstance(parsed, str):
+            self.writeError(400, ResultStatus.ValidationError, parsed)
+            return
+        sendType, datas = parsed
+        try:
+            stamp = await tornado.ioloop.IOLoop.current().run_in_executor(None, AnnounceHandler.save, datas)
+        except RepositoryException as ex:
+            if log.isError():
+                self.logger.exception("リポジトリエラー:%s", ex)
+            self.writeError(500, ResultStatus.RepositoryError)
+            return
+        savedTime = time.monotonic()
+        results = list()
+        sentCount = 0
+        failedCount = 0
+        for data in datas:
+            pushMessage = PushMessage(data, stamp)
+            if sendType == SendType.All:
+                sendList = SessionManager.getSessionInfos(data.compe_no)
+            else:
+                sendList = SessionManager.getParticipantSessionInfos(data.compe_no)
+            deliveredCount = 0
+            for info in sendList:
+                if sentCount > 0 and sentCount % AnnounceHandler.chunkSize == 0:
+                    await tornado.gen.sleep(0)
+                sentCount += 1
+                try:
+                    info.session.writeResult(pushMessage.get(info))
+                    deliveredCount += 1
+                except tornado.websocket.WebSocketClosedError:
+                    failedCount += 1
+            results.append({ "compe_no": data.compe_no, "message_id": data.message_id, "delivered": deliveredCount })
+        finished = time.monotonic()
+        deliveredTotal = sentCount - failedCount
+        if log.isInfo():
+            self.logger.info("お知らせ送信 compes:" + str(len(datas)) + ", delivered:" + str(deliveredTotal) + ", time(ms):" + str(int((finished - started) * 1000)))
+        self.write({
+            "status": ResultStatus.Success.value,
+            "messages": results,
+            "delivered": deliveredTotal,
+            "failed": failedCount,
+            "save_ms": round((savedTime - started) * 1000, 1),
+            "duration_ms": round((finished - started) * 1000, 1)
+            })
@@ -0,0 +1,300 @@
+#coding: UTF-8
+
+import collections
+import threading
+import time
+import tornado.gen
+import tornado.ioloop
+from src import log
+from src.config import inifile
+from src.enums import ReceptLevel
+from src.util import ValueUtils
+from src.repository import RepositoryFactory, SendMessageData, GetMessagesData, StampData, filterMessages, toStampId
+
+def sortKey(data: SendMessageData) -> tuple:
+    return (data.time, data.message_id)
+
+class StampCache():
+    """
+    スタンプ一覧のキャッシュ
+    stampReloadSeconds経過後の参照時に再読込する。
+    """
+    logger = log.getLog(__name__)
+    reloadSeconds = inifile.getint('cache', 'stampReloadSeconds', fallback=300)
+    stamps = None
+    stampMap = dict()
+    loadedTime = 0
+
+    @staticmethod
+    def setStamps(stamps: list):
+        StampCache.stampMap = { stamp.stamp_id: stamp for stamp in stamps }
+        StampCache.stamps = stamps
+        StampCache.loadedTime = time.monotonic()
+
+    @staticmethod
+    def findStamps() -> list:
+        if StampCache.stamps is None or time.monotonic() - StampCache.loadedTime > StampCache.reloadSeconds:
+            with RepositoryFactory.createStampMst(True) as stampMst:
+                StampCache.setStamps(stampMst.findStamps())
+            if log.isDebug():
+                StampCache.logger.debug("stamps loaded:" + str(len(StampCache.stamps)))
+        return StampCache.stamps
+
+    @staticmethod
+    def findStamp(stampId) -> StampData:
+        stampId = toStampId(stampId)
+        if stampId is None:
+            return None
+        StampCache.findStamps()
+        return StampCache.stampMap.get(stampId)
+
+def toGetMessagesData(data: SendMessageData) -> GetMessagesData:
+    """
+    保持しているメッセージを、findMessagesの結果と同じ形式に変換する。
+    """
+    stamp = StampCache.findStamp(data.stamp_id)
+    return GetMessagesData(
+            data.message_id,
+            data.send_type,
+            data.compe_no,
+            data.member_id,
+            data.time,
+            data.message,
+            None if stamp is None else stamp.stamp_url,
+            None if stamp is None else stamp.stamp_id
+            )
+
+class MessageWindow:
+    """
+    コンペ毎に保持する直近のメッセージ(時刻の昇順)
+    Attributes:
+    datas(list(SendMessageData)):メッセージ
+    complete(bool):コンペの全メッセージを保持しているか否か
+    lastMessageId(int):保持している最新(最大)のメッセージID
+    checkedTime(float):DBの最新のメッセージIDと照合した時刻(time.monotonic)
+    loadedTime(float):DBから読み込んだ時刻(time.monotonic)
+    """
+    def __init__(self, datas: list, complete: bool):
+        self.datas = datas
+        self.complete = complete
+        self.lastMessageId = max((data.message_id for data in datas), default=0)
+        self.checkedTime = time.monotonic()
+        self.loadedTime = self.checkedTime
+
+    def covers(self, afterMessageId: int) -> bool:
+        """
+        指定したメッセージIDより後のメッセージを全て保持しているか否か
+        """
+        return afterMessageId > 0 and len(self.datas) > 0 and afterMessageId >= self.datas[0].message_id
+
+class MessageCache():
+    """
+    メッセージのキャッシュ
+    起動時に当日アクティブなコンペの直近メッセージを読み込み、以降は送信されたメッセージを追加する。
+    起動後にアクティブになったコンペは、最初の取得時にDBから読み込む。
+    他プロセス(複数ワーカー、再起動時の旧プロセス)から送信されたメッセージを反映するため、
+    refreshSeconds経過後の参照時にDBの最新のメッセージIDと照合し、異なる場合は読み込み直す。
+    最新のメッセージIDでは検出できない変更(他プロセスでの削除、小さいIDの遅れたコミット)を反映するため、
+    読込からreloadSeconds経過後の参照時は照合せずに読み込み直す。
+    保持している範囲で結果が確定する検索のみメモリから返却し、それ以外はDBを検索する。
+    保持するコンペはmaxCompes件までとし、超過した場合は最も長く参照されていないコンペを破棄する。
+    (サービス実行スレッドから参照されるため、lockで保護する。)
+    """
+    logger = log.getLog(__name__)
+    lock = threading.RLock()
+    windowSize = inifile.getint('cache', 'messageWindow', fallback=500)
+    refreshSeconds = inifile.getfloat('cache', 'refreshSeconds', fallback=2)
+    reloadSeconds = inifile.getfloat('cache', 'windowReloadSeconds', fallback=60)
+    maxCompes = inifile.getint('cache', 'maxCompes', fallback=1000)
+    windows = collections.OrderedDict()
+    # 起動時の読込中に送信されたメッセージ
+    pending = list()
+    # コンペ毎の読込中(読み込み直しを含む)に送信されたメッセージ
+    loading = dict()
+    isInstalled = False
+
+    @staticmethod
+    def install(windows: dict):
+        """
+        起動時に読み込んだメッセージを設定する。
+        """
+        with MessageCache.lock:
+            for data in MessageCache.pending:
+                window = windows.get(data.compe_no)
+                if window is not None and data.message_id not in [it.message_id for it in window.datas]:
+                    MessageCache.insert(window, data)
+            MessageCache.pending = list()
+            MessageCache.windows = collections.OrderedDict(windows)
+            MessageCache.isInstalled = True
+
+    @staticmethod
+    def add(data: SendMessageData):
+        with MessageCache.lock:
+            if not MessageCache.isInstalled:
+                MessageCache.pending.append(data)
+                return
+            window = MessageCache.windows.get(data.compe_no)
+            if window is not None:
+                MessageCache.insert(window, data)
+            if data.compe_no in MessageCache.loading:
+                MessageCache.loading[data.compe_no].append(data)
+
+    @staticmethod
+    def insert(window: MessageWindow, data: SendMessageData):
+        datas = window.datas
+        # 通常は末尾への追加となる。
+        index = len(datas)
+        while index > 0 and sortKey(datas[index - 1]) > sortKey(data):
+            index -= 1
+        datas.insert(index, data)
+        window.lastMessageId = max(window.lastMessageId, data.message_id)
+        if len(datas) > MessageCache.windowSize:
+            del datas[0:len(datas) - MessageCache.windowSize]
+            window.complete = False
+
+    @staticmethod
+    def getWindow(compeNo: int) -> MessageWindow:
+        """
+        対象コンペの保持しているメッセージを取得する。
+        未読込の場合、DBの最新のメッセージIDと異なる場合、あるいは読込からreloadSeconds経過した場合はDBから読み込む。
+        (他のスレッドで読込中、あるいは読込エラーの場合はNone)
+        """
+        with MessageCache.lock:
+            if not MessageCache.isInstalled:
+                return None
+            window = MessageCache.windows.get(compeNo)
+            if window is not None:
+                MessageCache.windows.move_to_end(compeNo)
+                now = time.monotonic()
+                if now - window.checkedTime < MessageCache.refreshSeconds:
+                    return window
+                # 照合は1スレッドのみ行い、他のスレッドは照合済みとして扱う。
+                window.checkedTime = now
+                lastMessageId = window.lastMessageId
+                isExpired = now - window.loadedTime >= MessageCache.reloadSeconds
+            elif compeNo in MessageCache.loading:
+                return None
+            MessageCache.loading[compeNo] = list()
+        try:
+            with RepositoryFactory.createMessageDat(True) as messageDat:
+                if window is not None and not isExpired and messageDat.findLastMessageId(compeNo) <= lastMessageId:
+                    with MessageCache.lock:
+                        MessageCache.loading.pop(compeNo, None)
+                    return window
+                datas = messageDat.findLatestMessages(compeNo, MessageCache.windowSize)
+        except Exception as ex:
+            with MessageCache.lock:
+                MessageCache.loading.pop(compeNo, None)
+            if log.isWarning():
+                MessageCache.logger.warning("message cache load error compe_no:" + str(compeNo) + ", " + str(ex))
+            return None
+        with MessageCache.lock:
+            # 読込中に追加されたメッセージを反映する。
+            # (保持していたメッセージはDBの内容で置き換え、他プロセスで削除されたメッセージを除く。)
+            added = MessageCache.loading.pop(compeNo, [])
+            window = MessageWindow(datas, len(datas) < MessageCache.windowSize)
+            messageIds = set(data.message_id for data in datas)
+            for data in added:
+                if data.message_id not in messageIds:
+                    MessageCache.insert(window, data)
+                    messageIds.add(data.message_id)
+            windows = MessageCache.windows
+            windows[compeNo] = window
+            windows.move_to_end(compeNo)
+            while len(windows) > MessageCache.maxCompes:
+                evictedCompeNo, _ = windows.popitem(last=False)
+                if log.isDebug():
+                    MessageCache.logger.debug("message cache evicted compe_no:" + str(evictedCompeNo))
+        if log.isDebug():
+            MessageCache.logger.debug("message cache loaded compe_no:" + str(compeNo) + ", messages:" + str(len(window.datas)))
+        return window
+
+    @staticmethod
+    def findMessages(receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: int, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
+        """
+        findMessagesと同じ条件でメッセージを取得する。
+        保持しているメッセージで結果が確定しない場合はNoneを返す。
+        """
+        window = MessageCache.getWindow(compeNo)
+        if window is None:
+            return None
+        with MessageCache.lock:
+            datas = filterMessages(window.datas, receptLevel, beforeTime, count, memberId, excludeMyself, afterMessageId)
+            if not window.complete and (count <= 0 or len(datas) < count) and not window.covers(afterMessageId):
+                return None
+        return [toGetMessagesData(data) for data in datas]
+
+    @staticmethod
+    def countMessages() -> int:
+        with MessageCache.lock:
+            return sum(len(window.datas) for window in MessageCache.windows.values())
+
+class SentMessageCache():
+    """
+    送信済みメッセージの重複排除
+    (コンペ番号, 会員ID, クライアントのメッセージID)毎に登録したメッセージIDを、直近dedupWindow件まで保持する。
+    保持範囲外の再送はDBの一意キーで検出する。
+    """
+    lock = threading.RLock()
+    windowSize = inifile.getint('cache', 'dedupWindow', fallback=10000)
+    messageIdMap = collections.OrderedDict()
+
+    @staticmethod
+    def find(compeNo: int, memberId: str, clientMessageId: str) -> int:
+        with SentMessageCache.lock:
+            return SentMessageCache.messageIdMap.get((compeNo, memberId, clientMessageId))
+
+    @staticmethod
+    def add(compeNo: int, memberId: str, clientMessageId: str, messageId: int):
+        with SentMessageCache.lock:
+            messageIdMap = SentMessageCache.messageIdMap
+            messageIdMap[(compeNo, memberId, clientMessageId)] = messageId
+            while len(messageIdMap) > SentMessageCache.windowSize:
+                messageIdMap.popitem(last=False)
+
+class WarmupManager():
+    """
+    起動時の準備処理
+    リポジトリの初期化(コネクションプールの生成など)、スタンプ一覧と当日アクティブなコンペのメッセージの読込を行う。
+    完了するまでは、各処理はDBを検索する。
+    """
+    logger = log.getLog(__name__)
+    activeHours = inifile.getint('cache', 'activeHours', fallback=24)
+    retrySeconds = inifile.getint('cache', 'warmupRetrySeconds', fallback=5)
+    isReady = False
+
+    @staticmethod
+    async def start():
+        """
+        準備処理を行う。
+        読込エラーの場合は準備中(/readyは503)のまま、retrySeconds毎に再実行する。
+        """
+        started = time.monotonic()
+        while True:
+            try:
+                windows = await tornado.ioloop.IOLoop.current().run_in_executor(None, WarmupManager.load)
+                break
+            except Exception as ex:
+                if log.isError():
+                    WarmupManager.logger.exception("起動時の読込エラー:%s", ex)
+            await tornado.gen.sleep(WarmupManager.retrySeconds)
+        MessageCache.install(windows)
+        WarmupManager.isReady = True
+        if log.isInfo():
+            WarmupManager.logger.info("warmup end compes:" + str(len(windows)) + ", messages:" + str(MessageCache.countMessages()) + ", time(ms):" + str(int((time.monotonic() - started) * 1000)))
+
+    @staticmethod
+    def load() -> dict:
+        """
+        DBからの読込(IOLoopとは別スレッドで実行する。)
+        """
+        RepositoryFactory.open()
+        StampCache.findStamps()
+        windows = dict()
+        sinceTime = ValueUtils.getTimeInMillis() - WarmupManager.activeHours * 60 * 60 * 1000
+        windowSize = MessageCache.windowSize
+        with RepositoryFactory.createMessageDat() as messageDat:
+            for compeNo in messageDat.findActiveCompeNos(sinceTime):
+                datas = messageDat.findLatestMessages(compeNo, windowSize)
+                windows[compeNo] = MessageWindow(datas, len(datas) < windowSize)
+        return windows
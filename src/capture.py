@@ -0,0 +1,142 @@
+#coding: UTF-8
+
+import base64
+import gzip
+import itertools
+import json
+import queue
+import threading
+import time
+from src import log
+from src.config import inifile
+
+class CaptureManager():
+    """
+    受信フレームの記録(リプレイ用)
+    接続・受信・切断をjson形式(1行1イベント)でファイルに出力する。(拡張子が.gzの場合は圧縮する。)
+    各行の項目は以下の通り。(ファイルサイズを抑えるため短縮名とする。)
+      t: 記録開始からの経過時間(ミリ秒)
+      s: セッション番号(記録毎の連番)
+      e: イベント(open、msg、close)
+      p: 受信フレーム(テキスト)、b: 受信フレーム(バイナリ、base64)
+      c: 送受信形式(openのみ)
+    ファイル出力はIOLoopを止めないよう別スレッドで行う。
+    ファイルは停止時(stop)まで開いたままとし、flushSecondsの間隔で書き出す。
+    (圧縮ファイルは書き出し毎に同期点を出力するため、記録中も書き出し済みの分を読み込める。)
+    """
+    logger = log.getLog(__name__)
+    enabled = inifile.getboolean('capture', 'enabled', fallback=False)
+    filePath = inifile.get('capture', 'filePath', fallback='')
+    flushSeconds = inifile.getfloat('capture', 'flushSeconds', fallback=1)
+    writeQueue = queue.Queue(maxsize=inifile.getint('capture', 'queueSize', fallback=10000))
+    writeThread = None
+    startTime = time.monotonic()
+    sessionNos = itertools.count(1)
+
+    @staticmethod
+    def setting():
+        """
+        記録の開始(起動時に実行する。)
+        """
+        if not CaptureManager.enabled:
+            return
+        if not CaptureManager.filePath:
+            CaptureManager.enabled = False
+            return
+        CaptureManager.startTime = time.monotonic()
+        if CaptureManager.writeThread is None:
+            CaptureManager.writeThread = threading.Thread(target=CaptureManager.writeLoop, name="capture-writer", daemon=True)
+            CaptureManager.writeThread.start()
+        if log.isInfo():
+            CaptureManager.logger.info("capture start:" + CaptureManager.filePath)
+
+    @staticmethod
+    def stop():
+        """
+        書込待ちのイベントを書き出してファイルを閉じる。(停止時に実行する。)
+        """
+        writeThread = CaptureManager.writeThread
+        if writeThread is None:
+            return
+        CaptureManager.enabled = False
+        try:
+            # 書込スレッドへの終了通知
+            CaptureManager.writeQueue.put(None, timeout=CaptureManager.flushSeconds)
+            writeThread.join(CaptureManager.flushSeconds + 5)
+        except queue.Full:
+            if log.isWarning():
+                CaptureManager.logger.warning("capture stop timeout")
+        CaptureManager.writeThread = None
+        if log.isInfo():
+            CaptureManager.logger.info("capture stop:" + CaptureManager.filePath)
+
+    @staticmethod
+    def open(session, codecName: str):
+        session.captureNo = next(CaptureManager.sessionNos)
+        CaptureManager.record({ "s": session.captureNo, "e": "open", "c": codecName })
+
+    @staticmethod
+    def message(session, message):
+        if session.captureNo is None:
+            return
+        event = { "s": session.captureNo, "e": "msg" }
+        if isinstance(message, bytes):
+            event["b"] = base64.b64encode(message).decode("ascii")
+        else:
+            event["p"] = message
+        CaptureManager.record(event)
+
+    @staticmethod
+    def close(session):
+        if session.captureNo is None:
+            return
+        CaptureManager.record({ "s": session.captureNo, "e": "close" })
+
+    @staticmethod
+    def record(event: dict):
+        event["t"] = round((time.monotonic() - CaptureManager.startTime) * 1000, 1)
+        try:
+            CaptureManager.writeQueue.put_nowait(event)
+        except queue.Full:
+            if log.isWarning():
+                CaptureManager.logger.warning("capture queue full session:" + str(event["s"]))
+
+    @staticmethod
+    def openFile():
+        if CaptureManager.filePath.endswith(".gz"):
+            return gzip.open(CaptureManager.filePath, "at", encoding="utf-8")
+        return open(CaptureManager.filePath, "a", encoding="utf-8")
+
+    @staticmethod
+    def writeLoop():
+        file = None
+        flushedTime = time.monotonic()
+        isDirty = False
+        while True:
+            try:
+                event = CaptureManager.writeQueue.get(timeout=CaptureManager.flushSeconds)
+                isIdle = False
+            except queue.Empty:
+                event = None
+                isIdle = True
+            try:
+                if not isIdle:
+                    if event is None:
+                        # 停止(stop)
+                        if file is not None:
+                            file.close()
+                        return
+                    if file is None:
+                        file = CaptureManager.openFile()
+                    file.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    isDirty = True
+                now = time.monotonic()
+                if isDirty and (isIdle or now - flushedTime >= CaptureManager.flushSeconds):
+                    file.flush()
+                    flushedTime = now
+                    isDirty = False
+            except Exception as ex:
+                file = None
+                isDirty = False
+                if log.isError():
+                    CaptureManager.logger.error("capture write error:" + str(ex))
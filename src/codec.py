@@ -0,0 +1,112 @@
+#coding: UTF-8
+
+import json
+from typing import Any
+from src import log
+from src.data import Serializable, jsonDefault
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class CodecBase:
+    """
+    WebSocketの送受信形式
+    Attributes:
+    name(str):WebSocketのサブプロトコル名
+    binary(bool):バイナリフレームで送信するか否か
+    """
+    name: str = None
+    binary: bool = False
+
+    def encode(self, result: Serializable) -> Any:
+        raise NotImplementedError
+
+    def decode(self, message: Any) -> Any:
+        raise NotImplementedError
+
+class JsonCodec(CodecBase):
+    name = "json"
+    binary = False
+
+    def encode(self, result: Serializable) -> Any:
+        return result.toJson()
+
+    def decode(self, message: Any) -> Any:
+        return json.loads(message)
+
+class MsgpackCodec(CodecBase):
+    name = "msgpack"
+    binary = True
+
+    def encode(self, result: Serializable) -> Any:
+        return msgpack.packb(result, default=jsonDefault, use_bin_type=True)
+
+    def decode(self, message: Any) -> Any:
+        try:
+            return msgpack.unpackb(message, raw=False)
+        except Exception as ex:
+            raise ValueError(*ex.args)
+
+def cborDefault(encoder, value):
+    encoder.encode(value.__dict__)
+
+class CborCodec(CodecBase):
+    name = "cbor"
+    binary = True
+
+    def encode(self, result: Serializable) -> Any:
+        return cbor2.dumps(result, default=cborDefault)
+
+    def decode(self, message: Any) -> Any:
+        try:
+            return cbor2.loads(message)
+        except Exception as ex:
+            raise ValueError(*ex.args)
+
+class Codecs():
+    """
+    送受信形式の管理
+    クライアントがWebSocketのサブプロトコルで指定した形式を使用する。(未指定の場合はjson)
+    msgpack、cbor2がインストールされていない場合、その形式は選択できない。
+    """
+    logger = log.getLog(__name__)
+    default = JsonCodec()
+    codecMap = { codec.name: codec for codec in [
+        default,
+        MsgpackCodec() if msgpack is not None else None,
+        CborCodec() if cbor2 is not None else None
+        ] if codec is not None }
+
+    @staticmethod
+    def select(subprotocols: list) -> CodecBase:
+        """
+        クライアントが要求したサブプロトコルから、最初に対応可能な形式を選択する。
+        """
+        for subprotocol in subprotocols:
+            codec = Codecs.codecMap.get(subprotocol)
+            if codec is not None:
+                return codec
+        return None
+
+class EncodedResult:
+    """
+    送信形式毎の変換結果を保持する返却値
+    複数セッションへ同じ内容を送信する場合に、形式毎に1回だけ変換するために使用する。
+    """
+    def __init__(self, result: Serializable):
+        self.result = result
+        self.payloads = dict()
+
+    def get(self, codec: CodecBase) -> Any:
+        payload = self.payloads.get(codec.name)
+        if payload is None:
+            payload = codec.encode(self.result)
+            self.payloads[codec.name] = payload
+        return payload
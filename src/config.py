@@ -0,0 +1,9 @@
+#coding: UTF-8
+"""
+設定値(config.ini)
+起動時に1回だけ読み込み、各モジュールはこのinifileを参照する。
+"""
+import configparser
+
+inifile = configparser.ConfigParser()
+inifile.read('./config.ini', 'UTF-8')
@@ -48,3 +48,63 @@ class ServerResult(Serializable):
         result.status = status.value
         return result
 
+class CompactMessages():
+    """
+    メッセージ一覧の短縮形式
+    共通項目(compe_no、基準時刻)をheaderにまとめ、各メッセージはfieldsの順の配列で表す。
+    timeは直前のメッセージ(先頭はheader.base_time)からの差分(ミリ秒)、スタンプはstamp_idのみとする。
+    (スタンプURLはGetStampsで取得したスタンプ一覧から参照する。)
+    """
+    fields = ["message_id", "send_type", "member_id", "time", "message", "stamp_id"]
+
+    @staticmethod
+    def setMessages(result: ServerResult, compeNo: int, datas: list):
+        """
+        resultにメッセージ一覧を短縮形式で設定する。
+        datas: GetMessagesDataのリスト(時刻の昇順)
+        """
+        header = Serializable()
+        header.compe_no = compeNo
+        header.base_time = datas[0].time if len(datas) > 0 else 0
+        header.fields = CompactMessages.fields
+        if len(datas) > 0:
+            # 次回以降の取得範囲の指定用
+            header.first_message_id = datas[0].message_id
+            header.last_message_id = datas[-1].message_id
+        messages = list()
+        prevTime = header.base_time
+        for data in datas:
+            messages.append([data.message_id, data.send_type, data.member_id, data.time - prevTime, data.message, data.stamp_id])
+            prevTime = data.time
+        result.header = header
+        result.messages = messages
+
+    @staticmethod
+    def expand(result: dict, stampUrls: dict) -> dict:
+        """
+        短縮形式のレスポンス(json変換後のdict)を通常形式に戻す。(クライアント実装、検証用)
+        通常形式と同様に、送信分(GetMessagesFromSend)はスタンプがない場合にstampを出力しない。
+        stampUrls: stamp_idとstamp_urlの対応(GetStampsの結果)
+        """
+        header = result["header"]
+        isPush = result.get("method") == MethodType.GetMessagesFromSend.value
+        messages = list()
+        time = header["base_time"]
+        for row in result["messages"]:
+            item = dict(zip(header["fields"], row))
+            time += item["time"]
+            message = {
+                "send_type": item["send_type"],
+                "message_id": item["message_id"],
+                "compe_no": header["compe_no"],
+                "member_id": item["member_id"],
+                "time": time,
+                "message": item["message"]
+            }
+            stamp = stampUrls.get(item["stamp_id"])
+            if stamp is not None or not isPush:
+                message["stamp"] = stamp
+            messages.append(message)
+        expanded = dict((key, value) for key, value in result.items() if key != "header")
+        expanded["messages"] = messages
+        return expanded
@@ -13,6 +13,7 @@ class ResultStatus(Enum):
     ResultError = 90002 #/** 返却値エラー */
     MethodError = 90003 #/** 処理タイプ未定義、あるいはMethodType変換エラー */
     RepositoryError = 90004 #/** リポジトリエラー */
+    RateLimitError = 90005 #/** 流量制限エラー */
     ValidationError = 90100 #/** パラメータバリデーションエラー */
     ServerError = 99999 #/** サーバー内部エラー */
 
@@ -42,6 +43,10 @@ class MethodType(ParsableEnum):
     SendMessage = 3 #/** メッセージ送信 */
     GetStamps = 4 #/** スタンプ取得 */
     GetNewMessages = 5 #/** 新着メッセージ取得 */
+    Subscribe = 6 #/** コンペ受信追加 */
+    Unsubscribe = 7 #/** コンペ受信解除 */
+    SearchMessages = 8 #/** メッセージ検索 */
+    Reconnect = 98 #/** 再接続要求(サーバー通知) */
     GetMessagesFromSend = 99 #/** メッセージ取得(送信分) */
 
 class SendType(ParsableEnum):
@@ -1,65 +1,299 @@
-import json
+import collections
+import concurrent.futures
+import contextvars
+import dataclasses
+import math
+import threading
+import tornado.ioloop
+import tornado.web
 import tornado.websocket
 import uuid
-from src.data import ServerResult
+from src.data import ServerResult, Serializable
 from src.enums import ResultStatus, MethodType
-from src.manager import SessionManager
+from src.manager import SessionManager, ShutdownManager
 from src.service import ServiceBase, InitService, GetMessagesService, SendMessageService, GetStampsService,\
-    GetNewMessagesService
+    GetNewMessagesService, SubscribeService, UnsubscribeService, SearchMessagesService
 from src.util import ValueUtils
 from builtins import staticmethod
 from src import log
 from src.repository import RepositoryException
+from src.limiter import RateLimiter, AdmissionManager
+from src.codec import Codecs, EncodedResult
+from src.cache import WarmupManager
+from src.trace import Tracer, Trace
+from src.capture import CaptureManager
+from src.config import inifile
 
 initService = InitService()
 getNewMessagesService = GetNewMessagesService()
 getMessagesService = GetMessagesService()
 sendMessageService = SendMessageService()
 getStampsService = GetStampsService()
+subscribeService = SubscribeService()
+unsubscribeService = UnsubscribeService()
+searchMessagesService = SearchMessagesService()
+
+serviceThreads = inifile.getint('settings', 'serviceThreads', fallback=0)
+
+@dataclasses.dataclass
+class QueuedRequest:
+    """
+    セッション毎の待ち行列(CompeChatHandler.executeQueue)の要求
+    resultは実行前に確定したエラー応答(パラメータ不正、流量制限)。
+    admittedは全体の流量(AdmissionManager)の待ち時間中はFalse。
+    """
+    message: str = None
+    form: dict = None
+    method: MethodType = None
+    trace: Trace = None
+    result: ServerResult = None
+    admitted: bool = True
 
 class CompeChatHandler(tornado.websocket.WebSocketHandler):
     logger = log.getLog(__name__)
+    codec = Codecs.default
+    # サービス実行用のスレッドプール(serviceThreadsが0の場合はIOLoopのスレッドで実行する。)
+    executor = concurrent.futures.ThreadPoolExecutor(serviceThreads, "service") if serviceThreads > 0 else None
+    ioLoop: tornado.ioloop.IOLoop = None
+    ioLoopThreadId: int = None
+    # 受信フレームの記録時のセッション番号
+    captureNo: int = None
+    # 切断済み(on_close実行済み)
+    closed: bool = False
+    # 待ち行列(executeQueue)の要求を実行中
+    isExecuting: bool = False
 
     def check_origin(self, origin):
         return True
 
+    def select_subprotocol(self, subprotocols):
+        # サブプロトコルでバイナリ形式(msgpack、cbor)が指定された場合はその形式で送受信する。
+        codec = Codecs.select(subprotocols)
+        if codec is None:
+            return None
+        self.codec = codec
+        return codec.name
+
     def open(self, *args, **kwargs):
         self.id = str(uuid.uuid4())
+        self.rateLimits = dict()
+        self.executeQueue = collections.deque()
+        CompeChatHandler.ioLoop = tornado.ioloop.IOLoop.current()
+        CompeChatHandler.ioLoopThreadId = threading.get_ident()
+        if ShutdownManager.isDraining:
+            # 停止処理中は新規セッションを受け付けず、再接続を要求する。
+            self.writeReconnect(ShutdownManager.getReconnectDelay())
+            self.close(ShutdownManager.closeCode, "server restart")
+            return None
+        SessionManager.addConnection(self)
+        if CaptureManager.enabled:
+            CaptureManager.open(self, self.codec.name)
         return None
 
     def on_close(self):
         if log.isDebug():
             self.logger.debug("WebSocket session close:" + self.id);
+        self.closed = True
         SessionManager.removeSession(self);
+        SessionManager.removeConnection(self);
+        if CaptureManager.enabled:
+            CaptureManager.close(self)
+
+    def writeReconnect(self, delay: int):
+        """
+        再接続要求を送信する。
+        delay: 再接続までの待機時間(ミリ秒)
+        """
+        result = ServerResult.fromAll(MethodType.Reconnect, ResultStatus.Success)
+        result.reconnect = Serializable()
+        result.reconnect.delay = delay
+        try:
+            return self.writeResult(result)
+        except tornado.websocket.WebSocketClosedError:
+            return None
+
+    def writeResult(self, result):
+        """
+        セッションの送受信形式に変換して送信する。
+        result: ServerResult、あるいは複数セッションへ送信する場合はEncodedResult
+        """
+        if not isinstance(result, EncodedResult):
+            result = EncodedResult(result)
+        payload = result.get(self.codec)
+        if threading.get_ident() != CompeChatHandler.ioLoopThreadId:
+            # サービス実行スレッドからの送信は、IOLoopのスレッドで行う。
+            CompeChatHandler.ioLoop.add_callback(self.writePayload, payload)
+            return None
+        return self.write_message(payload, binary=self.codec.binary)
+
+    def writePayload(self, payload):
+        try:
+            self.write_message(payload, binary=self.codec.binary)
+        except tornado.websocket.WebSocketClosedError:
+            if log.isDebug():
+                self.logger.debug("WebSocket already closed:" + self.id)
 
     def on_message(self, message):
+        if CaptureManager.enabled:
+            CaptureManager.message(self, message)
+        trace = Tracer.start("on_message")
+        isQueued = False
+        try:
+            isQueued = self.receiveMessage(message, trace)
+        finally:
+            if not isQueued:
+                Tracer.finish(trace)
+
+    def receiveMessage(self, message, trace: Trace) -> bool:
+        """
+        受信メッセージの処理
+        待ち行列に入れて遅延実行する場合はTrueを返す。
+        """
         sessionId = self.id
+        Tracer.annotate("session_id", sessionId)
+        payload = message
+        if isinstance(payload, bytes):
+            # ログ出力用
+            message = repr(payload)
         if log.isDebug():
             self.logger.debug("セッションID:" + sessionId + ", メッセージ:" + message);
         try:
-            form = json.loads(message)
+            with Tracer.span("decode"):
+                form = self.codec.decode(payload)
+            if not isinstance(form, dict):
+                raise ValueError("not a map")
         except ValueError:
             if log.isError():
-                self.logger.error("クライアントパラメータのjson変換エラー セッションID:" + sessionId + ", メッセージ:" + message)
-            self.write_message(ServerResult.fromStatus(ResultStatus.ParamError).toJson())
-            return
+                self.logger.error("クライアントパラメータの" + self.codec.name + "変換エラー セッションID:" + sessionId + ", メッセージ:" + message)
+            self.writeErrorResult(ServerResult.fromStatus(ResultStatus.ParamError))
+            return False
         method = MethodType.parse(ValueUtils.getInt(form, "method"))
-        if method is None:
+        if method is None or CompeChatHandler.getService(method) is None:
+            # サーバーからの通知専用の処理タイプ(Reconnect、GetMessagesFromSend)も未定義とする。
             if log.isError():
                 self.logger.error("クライアントパラメータの処理タイプ未定義 セッションID:" + sessionId + ", メッセージ:" + message)
-            self.write_message(ServerResult.fromStatus(ResultStatus.MethodError).toJson())
+            self.writeErrorResult(ServerResult.fromStatus(ResultStatus.MethodError))
+            return False
+        Tracer.annotate("method", method.name)
+        sessionInfo = SessionManager.getSessionInfoFromId(sessionId)
+        wait = RateLimiter.check(self, method, None if sessionInfo is None else sessionInfo.memberId)
+        if wait > 0:
+            if log.isInfo():
+                self.logger.info("流量制限 セッションID:" + sessionId + ", 処理タイプ:" + method.name)
+            self.writeErrorResult(CompeChatHandler.createRateLimitResult(method, wait))
+            return False
+        wait = AdmissionManager.admit(method)
+        if wait < 0:
+            self.writeErrorResult(CompeChatHandler.createRateLimitResult(method, -wait))
+        elif wait > 0:
+            # 全体の流量を超えた場合は、待ち行列に入れて遅延実行する。
+            # 受信順を保つため、後続の要求(エラー応答を含む)はこの要求の後に実行する。
+            request = QueuedRequest(message, form, method, trace, admitted=False)
+            self.executeQueue.append(request)
+            tornado.ioloop.IOLoop.current().call_later(wait, self.admitQueued, request)
+            return True
+        else:
+            return self.executeMethod(message, form, method, trace)
+        return False
+
+    def admitQueued(self, request: "QueuedRequest"):
+        """
+        全体の流量の待ち時間の経過後に、待ち行列の要求を実行可能にする。
+        """
+        AdmissionManager.release()
+        request.admitted = True
+        Tracer.resume(request.trace)
+        Tracer.annotate("queued", True)
+        self.startExecute()
+
+    def executeMethod(self, message: str, form: dict, method: MethodType, trace: Trace) -> bool:
+        """
+        サービスを実行し、結果を送信する。
+        スレッドプールで実行する場合、あるいは実行待ちの要求がある場合は待ち行列に入れてTrueを返す。
+        (同一セッションの要求は受信順に1件ずつ実行する。)
+        """
+        if CompeChatHandler.executor is None and len(self.executeQueue) == 0:
+            result = self.executeService(message, form, CompeChatHandler.getService(method))
+            self.writeMethodResult(method, result)
+            return False
+        self.executeQueue.append(QueuedRequest(message, form, method, trace))
+        self.startExecute()
+        return True
+
+    def writeErrorResult(self, result: ServerResult):
+        """
+        サービス実行前のエラー(パラメータ不正、流量制限)を送信する。
+        実行待ち、実行中の要求がある場合は、受信順を保つためその応答の後に送信する。
+        """
+        if len(self.executeQueue) > 0:
+            self.executeQueue.append(QueuedRequest(result=result))
             return
-        service: ServiceBase = CompeChatHandler.getService(method)
-        result = self.executeService(message, form, service);
+        self.writeResult(result)
+
+    def startExecute(self):
+        if not self.isExecuting:
+            self.isExecuting = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.executeInOrder)
+
+    async def executeInOrder(self):
+        """
+        待ち行列の要求を受信順に実行する。
+        先頭の要求が全体の流量の待ち時間中の場合は、admitQueuedで再開する。
+        """
+        queue = self.executeQueue
+        try:
+            while len(queue) > 0 and queue[0].admitted:
+                request: QueuedRequest = queue[0]
+                if request.result is not None:
+                    # 実行待ちの間に発生したエラー
+                    queue.popleft()
+                    if not self.closed:
+                        self.writeResult(request.result)
+                    continue
+                Tracer.resume(request.trace)
+                try:
+                    if self.closed:
+                        continue
+                    service = CompeChatHandler.getService(request.method)
+                    if CompeChatHandler.executor is None:
+                        result = self.executeService(request.message, request.form, service)
+                    else:
+                        context = contextvars.copy_context()
+                        result = await tornado.ioloop.IOLoop.current().run_in_executor(CompeChatHandler.executor, context.run, self.executeService, request.message, request.form, service)
+                    if not self.closed:
+                        self.writeMethodResult(request.method, result)
+                except Exception as ex:
+                    if log.isError():
+                        self.logger.exception("サービス実行時のエラー:%s", ex)
+                finally:
+                    Tracer.finish(request.trace)
+                    # 実行が終わるまで先頭に残し、後続の要求を待ち行列に入れさせる。
+                    queue.popleft()
+        finally:
+            self.isExecuting = False
+
+    def writeMethodResult(self, method: MethodType, result: ServerResult):
         result.method = method.value
-        self.write_message(result.toJson())
+        with Tracer.span("write"):
+            self.writeResult(result)
+
+    @staticmethod
+    def createRateLimitResult(method: MethodType, wait: float) -> ServerResult:
+        """
+        流量制限エラーを生成する。
+        retry_after: 再試行可能になるまでの時間(ミリ秒)
+        """
+        result = ServerResult.fromAll(method, ResultStatus.RateLimitError)
+        result.retry_after = math.ceil(wait * 1000)
+        return result
 
     def executeService(self, message: str, form: dict, service: ServiceBase) -> ServerResult:
         sessionInfo = service.getSessionInfo(self)
         if sessionInfo is None:
             return ServerResult.fromStatus(ResultStatus.LoginError);
         try:
-            info: ValidationInfo = service.validate(form)
+            with Tracer.span("validate"):
+                info: ValidationInfo = service.validate(form)
             if info == None:
                 if log.isError():
                     self.logger.error("バリデーション不正(バリデーション結果がnull), メッセージ:" + message)
@@ -69,7 +303,10 @@ class CompeChatHandler(tornado.websocket.WebSocketHandler):
                 if log.isInfo():
                     self.logger.info("バリデーションエラー(" + info.name + "):" + errors + ", メッセージ:" + message)
                 return ServerResult.fromStatus(ResultStatus.ValidationError)
-            return service.execute(sessionInfo, service.createParam(form))
+            with Tracer.span("createParam"):
+                param = service.createParam(form)
+            with Tracer.span("execute:" + service.__class__.__name__):
+                return service.execute(sessionInfo, param)
         except RepositoryException as ex:
             if log.isError():
                 self.logger.exception("リポジトリエラー:%s", ex)
@@ -91,4 +328,21 @@ class CompeChatHandler(tornado.websocket.WebSocketHandler):
             return getStampsService
         elif method == MethodType.GetNewMessages:
             return getNewMessagesService
+        elif method == MethodType.Subscribe:
+            return subscribeService
+        elif method == MethodType.Unsubscribe:
+            return unsubscribeService
+        elif method == MethodType.SearchMessages:
+            return searchMessagesService
         return None
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """
+    起動準備の完了確認
+    準備処理(WarmupManager)の完了後は200、準備中あるいは停止処理中は503を返す。
+    """
+    def get(self):
+        isReady = WarmupManager.isReady and not ShutdownManager.isDraining
+        if not isReady:
+            self.set_status(503)
+        self.write({ "ready": isReady, "draining": ShutdownManager.isDraining })
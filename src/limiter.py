@@ -0,0 +1,158 @@
+#coding: UTF-8
+
+import time
+from src.config import inifile
+from src import log
+from src.enums import MethodType
+
+class TokenBucket:
+    """
+    トークンバケット
+    Attributes:
+    rate(float):1秒あたりの補充数
+    capacity(float):最大保持数(バースト数)
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self) -> float:
+        """
+        トークンを1つ消費する。
+        消費できた場合は0、できない場合は消費可能になるまでの秒数を返す。
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """
+        トークンを1つ予約する。(残数がマイナスになることを許容する。)
+        予約したトークンが使用可能になるまでの秒数を返す。
+        """
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def waitTime(self) -> float:
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def isFull(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+def parseLimit(value: str) -> tuple:
+    """
+    "1秒あたりの回数,バースト数"形式の設定値を変換する。
+    """
+    rate, burst = value.split(",")
+    return (float(rate), float(burst))
+
+def readLimits(scope: str) -> dict:
+    limits = dict()
+    if not inifile.has_section('ratelimit'):
+        return limits
+    for method in MethodType:
+        key = method.name.lower() + "." + scope
+        if inifile.has_option('ratelimit', key):
+            limits[method] = parseLimit(inifile.get('ratelimit', key))
+    return limits
+
+class RateLimiter():
+    """
+    流量制限
+    処理タイプ毎に、セッション単位、会員単位でトークンバケットによる制限を行う。
+    セッション単位のバケットはセッション(WebSocketHandler)に保持し、切断時に破棄する。
+    """
+    logger = log.getLog(__name__)
+    sessionLimits = readLimits("session")
+    memberLimits = readLimits("member")
+    memberBuckets = dict()
+    # 会員単位のバケットの掃除間隔(秒)
+    purgeInterval = 60
+    purgedTime = time.monotonic()
+
+    @staticmethod
+    def check(session, method: MethodType, memberId: str) -> float:
+        """
+        流量制限を判定する。
+        受け付ける場合は0、制限する場合は再試行可能になるまでの秒数を返す。
+        """
+        wait = 0
+        if method in RateLimiter.sessionLimits:
+            buckets = session.rateLimits
+            if method not in buckets:
+                buckets[method] = TokenBucket(*RateLimiter.sessionLimits[method])
+            wait = buckets[method].consume()
+            if wait > 0:
+                return wait
+        if memberId is not None and method in RateLimiter.memberLimits:
+            RateLimiter.purge()
+            key = (memberId, method)
+            buckets = RateLimiter.memberBuckets
+            if key not in buckets:
+                buckets[key] = TokenBucket(*RateLimiter.memberLimits[method])
+            wait = buckets[key].consume()
+        return wait
+
+    @staticmethod
+    def purge():
+        """
+        満杯(=制限中でない)の会員単位のバケットを破棄し、保持数を抑える。
+        """
+        now = time.monotonic()
+        if now - RateLimiter.purgedTime < RateLimiter.purgeInterval:
+            return
+        RateLimiter.purgedTime = now
+        buckets = RateLimiter.memberBuckets
+        for key in [key for key, bucket in buckets.items() if bucket.isFull()]:
+            del buckets[key]
+
+class AdmissionManager():
+    """
+    受付制御
+    処理タイプ毎にサーバー全体の流量を制限する。(Init、履歴読込など高コストな処理が対象)
+    流量を超えた要求は待ち行列に入れて順次実行し、待ち行列が一杯の場合のみ拒否する。
+    """
+    logger = log.getLog(__name__)
+    buckets = { method: TokenBucket(*limit) for method, limit in readLimits("global").items() }
+    queueSize = inifile.getint('ratelimit', 'admissionQueueSize', fallback=0)
+    waiting = 0
+
+    @staticmethod
+    def admit(method: MethodType) -> float:
+        """
+        受付可否を判定する。
+        即時実行できる場合は0、待ち行列に入れた場合は実行までの秒数、
+        拒否する場合はマイナス値(再試行までの秒数 * -1)を返す。
+        待ち行列に入れた場合は、実行時にrelease()を呼び出すこと。
+        """
+        bucket = AdmissionManager.buckets.get(method)
+        if bucket is None:
+            return 0
+        if AdmissionManager.waiting >= AdmissionManager.queueSize and bucket.waitTime() > 0:
+            if log.isWarning():
+                AdmissionManager.logger.warning("admission queue full method:" + method.name)
+            return -bucket.waitTime()
+        wait = bucket.reserve()
+        if wait > 0:
+            AdmissionManager.waiting += 1
+        return wait
+
+    @staticmethod
+    def release():
+        AdmissionManager.waiting -= 1
@@ -1,12 +1,10 @@
 # coding:utf-8
 
 import logging
-import configparser
+from src.config import inifile
 
 loggers = {}
 moduleName = "golferweb-compe-chat"
-inifile = configparser.ConfigParser()
-inifile.read('./config.ini', 'UTF-8')
 logLevel = logging.getLevelName(inifile.get('log', 'level'))
 
 def setting():
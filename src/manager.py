@@ -1,79 +1,346 @@
 #coding: UTF-8
 
 import tornado.websocket
+import tornado.ioloop
+import tornado.gen
 
 import dataclasses
+import random
+import threading
 from src import log
+from src.config import inifile
 from typing import Any
 from src.enums import ReceptLevel
 
 @dataclasses.dataclass
 class SessionInfo:
+    """
+    セッション情報
+    compeNo、receptLevelはinit時に指定したコンペ(各処理でcompe_no未指定の場合の対象)。
+    subscriptionsはinit時のコンペを含む、受信対象の全コンペ(コンペ番号と受信レベル)。
+    """
     session: Any
     compeNo: int = None
     memberId: str = None
     receptLevel: ReceptLevel = None
+    compact: bool = False
+    subscriptions: dict = dataclasses.field(default_factory=dict)
+
+class CompeTopic:
+    """
+    コンペ毎の送信先
+    送信タイプ毎の送信先を、受信レベルで振り分けて保持する。
+    送信時の取得用に一覧(tuple)を保持し、登録・削除時のみ作り直す。
+    Attributes:
+    allSessionMap(dict(str, SessionInfo)):全員(SendType.All)の送信先
+    participantSessionMap(dict(str, SessionInfo)):コンペ参加者(SendType.Compe)の送信先(ReceptLevel.All)
+    memberSessionMap(dict(str, dict(str, SessionInfo))):会員ID毎の送信先(SendType.User)
+    """
+    def __init__(self):
+        self.allSessionMap = dict()
+        self.participantSessionMap = dict()
+        self.memberSessionMap = dict()
+        self.clearSnapshot()
+
+    def clearSnapshot(self):
+        self.allSessions = None
+        self.participantSessions = None
+        self.memberSessions = dict()
+
+    def add(self, info: SessionInfo, receptLevel: ReceptLevel):
+        sessionId = info.session.id
+        self.allSessionMap[sessionId] = info
+        if receptLevel == ReceptLevel.All:
+            self.participantSessionMap[sessionId] = info
+        else:
+            self.participantSessionMap.pop(sessionId, None)
+        self.memberSessionMap.setdefault(info.memberId, dict())[sessionId] = info
+        self.clearSnapshot()
+
+    def remove(self, info: SessionInfo):
+        sessionId = info.session.id
+        self.allSessionMap.pop(sessionId, None)
+        self.participantSessionMap.pop(sessionId, None)
+        memberMap = self.memberSessionMap.get(info.memberId)
+        if memberMap is not None:
+            memberMap.pop(sessionId, None)
+            if len(memberMap) == 0:
+                del self.memberSessionMap[info.memberId]
+        self.clearSnapshot()
+
+    def isEmpty(self) -> bool:
+        return len(self.allSessionMap) == 0
+
+    def getAllSessions(self) -> tuple:
+        if self.allSessions is None:
+            self.allSessions = tuple(self.allSessionMap.values())
+        return self.allSessions
+
+    def getParticipantSessions(self) -> tuple:
+        if self.participantSessions is None:
+            self.participantSessions = tuple(self.participantSessionMap.values())
+        return self.participantSessions
+
+    def getMemberSessions(self, memberId: str) -> tuple:
+        sessions = self.memberSessions.get(memberId)
+        if sessions is None:
+            sessions = tuple(self.memberSessionMap.get(memberId, dict()).values())
+            self.memberSessions[memberId] = sessions
+        return sessions
+
+class SessionShard:
+    """
+    セッション管理の分割単位
+    コンペ番号毎の送信先を保持し、分割単位毎のロックで保護する。
+    Attributes:
+    topicMap(dict(int, CompeTopic)):コンペ番号毎の送信先
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.topicMap = dict()
 
 class SessionManager():
     """
     セッション管理
+    1つのセッションで複数のコンペを受信できる。(subscribe)
+    コンペ番号毎の送信先(CompeTopic)をshardCount個に分割し、分割単位毎のロックで保護する。
+    (サービスをIOLoop以外のスレッドで実行する場合も安全に参照できる。)
+    送信先の取得は作成済みの一覧を返すため、送信時に絞り込み・複製は行わず、送信中はロックを保持しない。
     """
     logger = log.getLog(__name__)
+    shardCount = max(1, inifile.getint('settings', 'sessionShards', fallback=16))
+    shards = [SessionShard() for _ in range(shardCount)]
+    idLock = threading.RLock()
     idSessionMap = dict()
-    compeIdsMap = dict()
+    connectionMap = dict()
+
+    @staticmethod
+    def getShard(compeNo: int) -> SessionShard:
+        return SessionManager.shards[hash(compeNo) % SessionManager.shardCount]
+
+    @staticmethod
+    def addConnection(session: tornado.websocket.WebSocketHandler):
+        """
+        接続中のWebSocketを登録する。(init未実行のものを含む)
+        """
+        with SessionManager.idLock:
+            SessionManager.connectionMap[session.id] = session
+
+    @staticmethod
+    def removeConnection(session: tornado.websocket.WebSocketHandler):
+        with SessionManager.idLock:
+            SessionManager.connectionMap.pop(session.id, None)
+
+    @staticmethod
+    def getConnections() -> list:
+        with SessionManager.idLock:
+            return list(SessionManager.connectionMap.values())
+
+    @staticmethod
+    def countConnections() -> int:
+        return len(SessionManager.connectionMap)
 
     @staticmethod
     def addSession(sessionInfo: SessionInfo):
+        """
+        init時のセッション登録
+        切断済み(on_close実行済み)のセッションは登録しない。
+        """
         sessionId = sessionInfo.session.id
-        SessionManager.idSessionMap[sessionId] = sessionInfo
         compeNo = sessionInfo.compeNo
-        idsMap = SessionManager.compeIdsMap
-        if compeNo in idsMap.keys():
-            ids = idsMap[compeNo]
-        else:
-            ids = list()
-            idsMap[compeNo] = ids
-        ids.append(sessionId)
+        with SessionManager.idLock:
+            if getattr(sessionInfo.session, "closed", False):
+                # サービス実行スレッドでのinit中に切断された場合
+                if log.isDebug():
+                    SessionManager.logger.debug("addSession skip closed id:" + sessionId)
+                return
+            oldInfo = SessionManager.idSessionMap.get(sessionId)
+            SessionManager.idSessionMap[sessionId] = sessionInfo
+        if oldInfo is not None:
+            # 再initの場合は、以前の受信対象から除外する。
+            SessionManager.unsubscribeAll(oldInfo)
+        SessionManager.subscribe(sessionInfo, compeNo, sessionInfo.receptLevel)
         if log.isDebug():
             SessionManager.logger.debug("addSession id:" + sessionId + ", compe_no:" + str(compeNo))
 
     @staticmethod
     def removeSession(session: tornado.websocket.WebSocketHandler):
+        """
+        切断時のセッション削除
+        (以降のaddSessionで登録されないよう、呼出元はsession.closedを設定してから実行する。)
+        """
         sessionId = session.id
-        idMap = SessionManager.idSessionMap
-        if sessionId in idMap.keys():
-            info = idMap.pop(sessionId)
-            idsMap = SessionManager.compeIdsMap
-            compeNo = info.compeNo
-            if compeNo in idsMap.keys():
-                idsMap[compeNo].remove(sessionId)
+        with SessionManager.idLock:
+            info = SessionManager.idSessionMap.pop(sessionId, None)
+        if info is not None:
+            SessionManager.unsubscribeAll(info)
         if log.isDebug():
             SessionManager.logger.debug("removeSession id:" + sessionId)
 
     @staticmethod
-    def getSessionInfos(compeNo: str = None) -> list:
+    def subscribe(sessionInfo: SessionInfo, compeNo: int, receptLevel: ReceptLevel):
+        """
+        対象コンペを受信対象に追加する。(受信済みの場合は受信レベルを変更する。)
+        """
+        shard = SessionManager.getShard(compeNo)
+        with shard.lock:
+            topic = shard.topicMap.get(compeNo)
+            if topic is None:
+                topic = CompeTopic()
+                shard.topicMap[compeNo] = topic
+            topic.add(sessionInfo, receptLevel)
+            sessionInfo.subscriptions[compeNo] = receptLevel
+        if SessionManager.getSessionInfoFromId(sessionInfo.session.id) is not sessionInfo:
+            # 追加中に切断(removeSession)、あるいは再initされた場合
+            SessionManager.unsubscribe(sessionInfo, compeNo)
+            return
+        if log.isDebug():
+            SessionManager.logger.debug("subscribe id:" + sessionInfo.session.id + ", compe_no:" + str(compeNo))
+
+    @staticmethod
+    def unsubscribe(sessionInfo: SessionInfo, compeNo: int):
+        shard = SessionManager.getShard(compeNo)
+        with shard.lock:
+            sessionInfo.subscriptions.pop(compeNo, None)
+            topic = shard.topicMap.get(compeNo)
+            if topic is not None:
+                topic.remove(sessionInfo)
+                if topic.isEmpty():
+                    del shard.topicMap[compeNo]
+        if log.isDebug():
+            SessionManager.logger.debug("unsubscribe id:" + sessionInfo.session.id + ", compe_no:" + str(compeNo))
+
+    @staticmethod
+    def unsubscribeAll(sessionInfo: SessionInfo):
+        for compeNo in list(sessionInfo.subscriptions.keys()):
+            SessionManager.unsubscribe(sessionInfo, compeNo)
+
+    @staticmethod
+    def getTopic(compeNo: int) -> CompeTopic:
+        shard = SessionManager.getShard(compeNo)
+        return shard.topicMap.get(compeNo)
+
+    @staticmethod
+    def getSessionInfos(compeNo: str = None) -> tuple:
+        """
+        対象コンペの全員(SendType.All)の送信先を取得する。
+        compeNoを省略した場合は、init済みの全セッション(WebSocketHandler)を取得する。
+        """
         if compeNo is None:
-            return map(lambda it:it.session, SessionManager.idSessionMap.values())
-        else:
-            idsMap = SessionManager.compeIdsMap
-            if compeNo not in idsMap.keys():
-                return list()
-            return map(lambda it:SessionManager.idSessionMap[it], idsMap[compeNo])
+            with SessionManager.idLock:
+                return [info.session for info in SessionManager.idSessionMap.values()]
+        shard = SessionManager.getShard(compeNo)
+        with shard.lock:
+            topic = shard.topicMap.get(compeNo)
+            if topic is None:
+                return ()
+            return topic.getAllSessions()
+
+    @staticmethod
+    def getParticipantSessionInfos(compeNo: int) -> tuple:
+        """
+        対象コンペの参加者(SendType.Compe、ReceptLevel.All)の送信先を取得する。
+        """
+        shard = SessionManager.getShard(compeNo)
+        with shard.lock:
+            topic = shard.topicMap.get(compeNo)
+            if topic is None:
+                return ()
+            return topic.getParticipantSessions()
+
+    @staticmethod
+    def getMemberSessionInfos(compeNo: int, memberId: str) -> tuple:
+        """
+        対象コンペを受信している会員のセッション(SendType.User)を取得する。
+        """
+        shard = SessionManager.getShard(compeNo)
+        with shard.lock:
+            topic = shard.topicMap.get(compeNo)
+            if topic is None:
+                return ()
+            return topic.getMemberSessions(memberId)
 
     @staticmethod
     def getSessionInfo(compeNo: str, memberId: str) -> SessionInfo:
-        idsMap = SessionManager.compeIdsMap
-        if compeNo not in idsMap.keys():
-            return None
-        infos = list(filter(lambda it:it.memberId == memberId, map(lambda it:SessionManager.idSessionMap[it], idsMap[compeNo])))
+        infos = SessionManager.getMemberSessionInfos(compeNo, memberId)
         if len(infos) == 0:
             return None
         return infos[0]
 
     @staticmethod
     def getSessionInfoFromId(sessionId: str) -> SessionInfo:
-        idMap = SessionManager.idSessionMap
-        if sessionId in idMap.keys():
-            return idMap[sessionId]
-        return None
+        return SessionManager.idSessionMap.get(sessionId)
 
+    @staticmethod
+    def countSessions() -> int:
+        return len(SessionManager.idSessionMap)
+
+class ShutdownManager():
+    """
+    停止管理
+    停止時は新規接続の受付を止め、接続中のクライアントへ再接続を要求してから
+    送信待ちのメッセージを書き出し、全セッションを切断してIOLoopを停止する。
+    再接続時期はクライアント毎にランダムに分散させ、再接続の集中(DB負荷のスパイク)を避ける。
+    """
+    logger = log.getLog(__name__)
+    # WebSocketのクローズコード(1001 = Going Away)
+    closeCode = 1001
+    isDraining = False
+    server = None
+    reconnectDelayMin = 1000
+    reconnectDelayMax = 30000
+    timeout = 10
+
+    @staticmethod
+    def setting(server, reconnectDelayMin: int, reconnectDelayMax: int, timeout: int):
+        ShutdownManager.server = server
+        ShutdownManager.reconnectDelayMin = reconnectDelayMin
+        ShutdownManager.reconnectDelayMax = max(reconnectDelayMin, reconnectDelayMax)
+        ShutdownManager.timeout = timeout
+
+    @staticmethod
+    def getReconnectDelay() -> int:
+        """
+        再接続までの待機時間(ミリ秒)をランダムに決定する。
+        """
+        return random.randint(ShutdownManager.reconnectDelayMin, ShutdownManager.reconnectDelayMax)
+
+    @staticmethod
+    def onSignal(signum, frame):
+        tornado.ioloop.IOLoop.current().add_callback_from_signal(ShutdownManager.drain)
+
+    @staticmethod
+    async def drain():
+        if ShutdownManager.isDraining:
+            return
+        ShutdownManager.isDraining = True
+        if log.isInfo():
+            ShutdownManager.logger.info("drain start connections:" + str(SessionManager.countConnections()))
+        if ShutdownManager.server is not None:
+            # 待受ソケットを閉じる。(SO_REUSEPORT利用時は新プロセスが同じポートで受付を継続する。)
+            ShutdownManager.server.stop()
+        sessions = SessionManager.getConnections()
+        writes = list()
+        for session in sessions:
+            write = session.writeReconnect(ShutdownManager.getReconnectDelay())
+            if write is not None:
+                writes.append(write)
+        try:
+            # 送信待ちのメッセージを書き出してから切断する。
+            await tornado.gen.with_timeout(ShutdownManager.getDeadline(), tornado.gen.multi(writes))
+        except Exception as ex:
+            if log.isWarning():
+                ShutdownManager.logger.warning("drain write timeout:%s", ex)
+        for session in sessions:
+            session.close(ShutdownManager.closeCode, "server restart")
+        deadline = ShutdownManager.getDeadline()
+        ioLoop = tornado.ioloop.IOLoop.current()
+        while SessionManager.countConnections() > 0 and ioLoop.time() < deadline:
+            await tornado.gen.sleep(0.1)
+        if log.isInfo():
+            ShutdownManager.logger.info("drain end remaining connections:" + str(SessionManager.countConnections()))
+        ioLoop.stop()
+
+    @staticmethod
+    def getDeadline() -> float:
+        return tornado.ioloop.IOLoop.current().time() + ShutdownManager.timeout
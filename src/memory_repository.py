@@ -0,0 +1,98 @@
+#coding: UTF-8
+
+import dataclasses
+import threading
+from src.enums import ReceptLevel
+from src.repository import DuplicateKeyException, MessageDatStorage, StampMstStorage, SendMessageData, GetMessagesData, StampData,\
+    createStaticStamps, filterMessages, toStampId
+
+class MemoryStore():
+    """
+    メモリ上のデータ
+    Attributes:
+    messageMap(dict(int, list(SendMessageData))):コンペ番号毎のメッセージ(時刻の昇順)
+    stampMap(dict(int, StampData)):スタンプ
+    clientMessageIdMap(dict(tuple, int)):(コンペ番号, 会員ID, クライアントのメッセージID)毎のメッセージID
+    """
+    lock = threading.RLock()
+    messageMap = dict()
+    clientMessageIdMap = dict()
+    stampMap = dict()
+    lastMessageId = 0
+
+def open_database():
+    with MemoryStore.lock:
+        if len(MemoryStore.stampMap) == 0:
+            MemoryStore.stampMap = { stamp.stamp_id: stamp for stamp in createStaticStamps() }
+
+class MemoryMessageDatRepository(MessageDatStorage):
+    """
+    メモリ上のメッセージのリポジトリ
+    登録は即時に反映する。(ロールバックは行わない。)
+    """
+
+    def findMessages(self, receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: str, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
+        with MemoryStore.lock:
+            datas = filterMessages(MemoryStore.messageMap.get(compeNo, []), receptLevel, beforeTime, count, memberId, excludeMyself, afterMessageId)
+        messages: list[GetMessagesData] = list()
+        for data in datas:
+            stamp = MemoryStore.stampMap.get(toStampId(data.stamp_id))
+            messages.append(GetMessagesData(
+                data.message_id,
+                data.send_type,
+                data.compe_no,
+                data.member_id,
+                data.time,
+                data.message,
+                None if stamp is None else stamp.stamp_url,
+                None if stamp is None else stamp.stamp_id
+                ))
+        return messages
+
+    def findActiveCompeNos(self, sinceTime: int) -> list:
+        with MemoryStore.lock:
+            return [compeNo for compeNo, datas in MemoryStore.messageMap.items()
+                    if any(data.time >= sinceTime and not data.is_delete for data in datas)]
+
+    def findLatestMessages(self, compeNo: int, count: int, afterMessageId: int = 0) -> list:
+        with MemoryStore.lock:
+            datas = [data for data in MemoryStore.messageMap.get(compeNo, [])
+                     if not data.is_delete and (afterMessageId <= 0 or data.message_id > afterMessageId)]
+            return [dataclasses.replace(data) for data in datas[-count:]]
+
+    def findLastMessageId(self, compeNo: int) -> int:
+        with MemoryStore.lock:
+            return max((data.message_id for data in MemoryStore.messageMap.get(compeNo, [])), default=0)
+
+    def findMessageId(self, compeNo: int, memberId: str, clientMessageId: str) -> int:
+        with MemoryStore.lock:
+            return MemoryStore.clientMessageIdMap.get((compeNo, memberId, clientMessageId))
+
+    def save(self, data: SendMessageData):
+        with MemoryStore.lock:
+            key = (data.compe_no, data.member_id, data.client_message_id)
+            if data.client_message_id is not None:
+                if key in MemoryStore.clientMessageIdMap:
+                    raise DuplicateKeyException("duplicate client_message_id:" + data.client_message_id)
+            MemoryStore.lastMessageId += 1
+            data.message_id = MemoryStore.lastMessageId
+            datas = MemoryStore.messageMap.setdefault(data.compe_no, list())
+            index = len(datas)
+            while index > 0 and (datas[index - 1].time, datas[index - 1].message_id) > (data.time, data.message_id):
+                index -= 1
+            datas.insert(index, dataclasses.replace(data))
+            if data.client_message_id is not None:
+                MemoryStore.clientMessageIdMap[key] = data.message_id
+
+    def saveAll(self, datas: list):
+        with MemoryStore.lock:
+            for data in datas:
+                self.save(data)
+
+class MemoryStampMstRepository(StampMstStorage):
+
+    def findStamps(self) -> list:
+        return sorted(MemoryStore.stampMap.values(), key=lambda it:it.stamp_id)
+
+    def findStamp(self, stampId: int) -> StampData:
+        return MemoryStore.stampMap.get(toStampId(stampId))
@@ -1,47 +1,221 @@
-import mysql.connector
+import os
 import dataclasses
-import configparser
+import itertools
+import threading
+import time
+from abc import abstractmethod
+from typing import Any
+from src.config import inifile
 from src.util import ValueUtils
 from builtins import str
 from src import log
-from src.enums import ReceptLevel
+from src.trace import Tracer
+from src.enums import ReceptLevel, SendType
+
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError:
+    # db.backendがmysql以外の場合は不要
+    mysql = None
 
-inifile = configparser.ConfigParser()
-inifile.read('./config.ini', 'UTF-8')
 DB_HOST = inifile.get('db', 'host')
 DB_PORT = ValueUtils.toInt(inifile.get('db', 'port'))
 DB_USER = inifile.get('db', 'user')
 DB_PASSWORD = inifile.get('db', 'password')
 DB_SCHEMA = inifile.get('db', 'schema')
+DB_POOL_SIZE = inifile.getint('db', 'poolSize', fallback=0)
+DB_BACKEND = inifile.get('db', 'backend', fallback='mysql')
+
+def parseList(value: str) -> list:
+    """
+    カンマ区切りの設定値を変換する。(空の要素は除く。)
+    """
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def parseHost(value: str) -> tuple:
+    """
+    "ホスト:ポート"形式の設定値を変換する。(ポート省略時は[db] portと同じ)
+    """
+    host, _, port = value.partition(":")
+    return (host, ValueUtils.toInt(port) if port else DB_PORT)
+
+class ReplicaRouter:
+    """
+    読込先の振分け
+    読込のみの処理はレプリカへ順番に振り分け、エラーとなったレプリカはfailureCooldown秒間除外する。
+    (全てのレプリカが除外中の場合はプライマリから読み込む。)
+    書き込んだ会員の読込は、stickySeconds秒間プライマリへ振り分ける。(自分の書き込みを確実に読めるようにする。)
+    Attributes:
+    replicas(list):レプリカ(mysql: (ホスト, ポート)、sqlite: ファイルパス)
+    failedTimes(dict):レプリカ毎のエラー発生時刻
+    writtenTimes(dict(str, float)):会員ID毎の書込時刻
+    """
+    logger = log.getLog(__name__)
+    failureCooldown = inifile.getfloat('replica', 'failureCooldown', fallback=30)
+    stickySeconds = inifile.getfloat('replica', 'stickySeconds', fallback=5)
+    # 書込時刻の掃除を行う保持数
+    purgeSize = 10000
+
+    def __init__(self, replicas: list):
+        self.replicas = replicas
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.failedTimes = dict()
+        self.writtenTimes = dict()
+
+    def choose(self, memberId: str = None) -> list:
+        """
+        読込先のレプリカを優先順に返す。(プライマリから読み込む場合は空)
+        """
+        if len(self.replicas) == 0:
+            return []
+        now = time.monotonic()
+        with self.lock:
+            if memberId is not None and now - self.writtenTimes.get(memberId, -self.stickySeconds) < self.stickySeconds:
+                return []
+            start = next(self.counter) % len(self.replicas)
+            ordered = self.replicas[start:] + self.replicas[:start]
+            return [replica for replica in ordered if now - self.failedTimes.get(replica, -self.failureCooldown) >= self.failureCooldown]
 
-def get_connection() -> mysql.connector:
-    return mysql.connector.connect(
-            host = DB_HOST,
-            port = DB_PORT,
+    def markFailed(self, replica, ex: Exception):
+        with self.lock:
+            self.failedTimes[replica] = time.monotonic()
+        if log.isWarning():
+            self.logger.warning("レプリカのエラー(" + str(self.failureCooldown) + "秒間除外):" + str(replica) + " " + str(ex))
+
+    def markWritten(self, memberId: str):
+        if len(self.replicas) == 0 or memberId is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            writtenTimes = self.writtenTimes
+            writtenTimes[memberId] = now
+            if len(writtenTimes) > self.purgeSize:
+                for key in [key for key, writtenTime in writtenTimes.items() if now - writtenTime >= self.stickySeconds]:
+                    del writtenTimes[key]
+
+mysqlReplicaRouter = ReplicaRouter([parseHost(host) for host in parseList(inifile.get('replica', 'hosts', fallback=''))])
+
+connectionPool = None
+replicaPools = dict()
+
+def get_connection_args(replica: tuple = None) -> dict:
+    host, port = (DB_HOST, DB_PORT) if replica is None else replica
+    return dict(
+            host = host,
+            port = port,
             user = DB_USER,
             password = DB_PASSWORD,
             database = DB_SCHEMA,
             auth_plugin='mysql_native_password'
         )
 
+def open_pool():
+    """
+    コネクションプールを生成する。(起動時に実行する。poolSizeが0の場合は使用しない。)
+    """
+    global connectionPool
+    if connectionPool is None and DB_POOL_SIZE > 0:
+        connectionPool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name = "golferweb-compe-chat",
+                pool_size = DB_POOL_SIZE,
+                **get_connection_args()
+            )
+        for index, replica in enumerate(mysqlReplicaRouter.replicas):
+            try:
+                replicaPools[replica] = mysql.connector.pooling.MySQLConnectionPool(
+                        pool_name = "golferweb-compe-chat-replica" + str(index),
+                        pool_size = DB_POOL_SIZE,
+                        **get_connection_args(replica)
+                    )
+            except Exception as ex:
+                # 起動時に接続できないレプリカは都度接続する。
+                mysqlReplicaRouter.markFailed(replica, ex)
+
+def get_connection(replica: tuple = None) -> Any:
+    """
+    replica: 接続先のレプリカ(Noneの場合はプライマリ)
+    """
+    if mysql is None:
+        raise ImportError("mysql-connector-pythonがインストールされていません。")
+    pool = connectionPool if replica is None else replicaPools.get(replica)
+    if pool is not None:
+        try:
+            return pool.get_connection()
+        except mysql.connector.errors.PoolError:
+            # プールが枯渇している場合は都度接続する。
+            pass
+    return mysql.connector.connect(**get_connection_args(replica))
+
 class RepositoryException(Exception):
     def __init__(self, message, *errors):
         Exception.__init__(self, message)
         self.errors = errors
 
+class DuplicateKeyException(RepositoryException):
+    """
+    一意キー制約違反
+    """
+    pass
+
+def isDuplicateKeyError(e: Exception) -> bool:
+    return mysql is not None and isinstance(e, mysql.connector.errors.IntegrityError) and e.errno == 1062
+
 class RepositoryBase:
+    """
+    DBリポジトリの基底クラス
+    readOnlyの場合はレプリカ(router)から読み込み、レプリカのエラー時はプライマリで再実行する。
+    書込み(execute)はプライマリのみとする。
+    """
     logger = log.getLog(__name__)
-    conn: mysql.connector
+    router: ReplicaRouter = mysqlReplicaRouter
+    conn: Any
+    replica: Any = None
     useTransaction: bool = False
     isComplete: bool = False
 
-    def __init__(self):
+    def __init__(self, readOnly: bool = False, memberId: str = None):
         try:
-            self.conn = get_connection()
+            with Tracer.span("connect"):
+                self.conn = self.connect(readOnly, memberId)
         except Exception as e:
             raise RepositoryException(*e.args)
         self.isComplete = False
 
+    def connect(self, readOnly: bool, memberId: str) -> Any:
+        if readOnly:
+            for replica in self.router.choose(memberId):
+                try:
+                    conn = self.openConnection(replica)
+                    self.replica = replica
+                    Tracer.annotate("replica", str(replica))
+                    return conn
+                except Exception as ex:
+                    self.router.markFailed(replica, ex)
+        return self.openConnection(None)
+
+    def openConnection(self, replica: Any) -> Any:
+        """
+        replica: 接続先のレプリカ(Noneの場合はプライマリ)
+        """
+        return get_connection(replica)
+
+    def failover(self, ex: Exception):
+        """
+        レプリカのエラー時に、プライマリへ接続し直す。
+        """
+        self.router.markFailed(self.replica, ex)
+        self.replica = None
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        try:
+            self.conn = self.openConnection(None)
+        except Exception as e:
+            raise RepositoryException(*e.args)
+
     def __enter__(self):
         return self
 
@@ -69,12 +243,22 @@ class RepositoryBase:
                 except Exception as e:
                     raise RepositoryException(*e.args)
 
-    def checkConnect(self, conn: mysql.connector):
+    def checkConnect(self, conn: Any):
         isConnected = conn.is_connected()
         if not isConnected:
             conn.ping(True)
 
-    def query(self, sql: str, param: tuple = ()) -> mysql.connector.cursor:
+    def query(self, sql: str, param: tuple = ()) -> Any:
+        with Tracer.span("sql:" + sql.split(None, 1)[0].lower()):
+            if self.replica is None:
+                return self.querySql(sql, param)
+            try:
+                return self.querySql(sql, param)
+            except RepositoryException as ex:
+                self.failover(ex)
+                return self.querySql(sql, param)
+
+    def querySql(self, sql: str, param: Any = ()) -> Any:
         try:
 #            self.logger.debug("sql:" + sql)
             conn = self.conn
@@ -87,7 +271,13 @@ class RepositoryBase:
         except Exception as e:
             raise RepositoryException(*e.args)
 
-    def execute(self, sql: str, param: tuple = ()) -> mysql.connector.cursor:
+    def execute(self, sql: str, param: tuple = ()) -> Any:
+        if self.replica is not None:
+            raise RepositoryException("レプリカへの書込みはできません。")
+        with Tracer.span("sql:" + sql.split(None, 1)[0].lower()):
+            return self.executeSql(sql, param)
+
+    def executeSql(self, sql: str, param: Any = ()) -> Any:
         try:
             self.useTransaction = True
             conn = self.conn
@@ -100,6 +290,8 @@ class RepositoryBase:
             return cur
         except Exception as e:
             self.isComplete = False
+            if isDuplicateKeyError(e):
+                raise DuplicateKeyException(*e.args)
             raise RepositoryException(*e.args)
 
 #     def getCursor(self, useTransaction: bool):
@@ -125,6 +317,7 @@ class SendMessageData:
     message: str
     stamp_id: str
     is_delete: bool
+    client_message_id: str = None
 
 @dataclasses.dataclass
 class GetMessagesData:
@@ -135,10 +328,117 @@ class GetMessagesData:
     time: int
     message: str
     stamp: str
+    stamp_id: int = None
+
+def isVisible(data: SendMessageData, receptLevel: ReceptLevel, memberId: str) -> bool:
+    """
+    メッセージが対象会員の受信対象か否か(findMessagesの宛先条件と同じ)
+    """
+    sendType = data.send_type
+    if sendType == SendType.All.value:
+        return True
+    if sendType == SendType.Compe.value:
+        return receptLevel == ReceptLevel.All
+    if sendType == SendType.User.value:
+        return data.dest_member_id == memberId or data.member_id == memberId
+    return False
+
+def filterMessages(datas: list, receptLevel: ReceptLevel, beforeTime: int, count: int, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
+    """
+    メッセージ一覧(SendMessageData、時刻の昇順)をfindMessagesと同じ条件で絞り込む。(時刻の昇順)
+    """
+    messages = list()
+    for data in reversed(datas):
+        if count > 0 and len(messages) >= count:
+            break
+        if data.is_delete:
+            continue
+        if beforeTime > 0 and data.time >= beforeTime:
+            continue
+        if afterMessageId > 0 and data.message_id <= afterMessageId:
+            continue
+        if excludeMyself and data.member_id == memberId:
+            continue
+        if not isVisible(data, receptLevel, memberId):
+            continue
+        messages.append(data)
+    messages.reverse()
+    return messages
+
+class MessageDatStorage:
+    """
+    メッセージのリポジトリ
+    バックエンド(mysql、sqlite、memory)毎に実装する。
+    """
+    def __init__(self, readOnly: bool = False, memberId: str = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def complete(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def findMessages(self, receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: str, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
+        """
+        対象コンペのメッセージ(GetMessagesData)を取得する。
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def findActiveCompeNos(self, sinceTime: int) -> list:
+        """
+        指定時間以降にメッセージのあるコンペ番号を取得する。
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def findLatestMessages(self, compeNo: int, count: int, afterMessageId: int = 0) -> list:
+        """
+        対象コンペの新着順からcount件のメッセージ(SendMessageData)を、宛先に関わらず取得する。
+        (afterMessageIdより後のメッセージに制限する。0以下の場合は制限しない。)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def findLastMessageId(self, compeNo: int) -> int:
+        """
+        対象コンペの最新(最大)のメッセージIDを取得する。(メッセージがない場合は0)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def findMessageId(self, compeNo: int, memberId: str, clientMessageId: str) -> int:
+        """
+        クライアントのメッセージIDから登録済みのメッセージIDを取得する。(未登録の場合はNone)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, data: SendMessageData):
+        """
+        メッセージを登録し、data.message_idを設定する。
+        クライアントのメッセージIDが登録済みの場合はDuplicateKeyExceptionとする。
+        """
+        raise NotImplementedError
 
-class MessageDatRepository(RepositoryBase):
+    @abstractmethod
+    def saveAll(self, datas: list):
+        """
+        複数のメッセージを1回のトランザクションで登録し、各data.message_idを設定する。
+        """
+        raise NotImplementedError
+
+class MessageDatRepository(RepositoryBase, MessageDatStorage):
 
-    def findMessages(self, receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: str, memberId: str, excludeMyself: bool) -> list:
+    def findMessages(self, receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: str, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
         """
         対象コンペのメッセージを取得する。
         Parameters
@@ -149,6 +449,8 @@ class MessageDatRepository(RepositoryBase):
             新着順からの件数制限(0以下の場合は制限しない。)
         excludeMyself : bool
             自分(memberId)が送信者のメッセージを除外するか否か
+        afterMessageId: int
+            指定したメッセージIDより後のメッセージに制限する。(0以下の場合は制限しない。)
         isParticipant : bool
             参加者か否か
                 Falseの場合、コンペ参加者宛のメッセージを除外して検索する。
@@ -157,15 +459,17 @@ class MessageDatRepository(RepositoryBase):
         destSql = self.ifStr(receptLevel == ReceptLevel.All, lambda: "        OR msg.send_type = 2 #コンペ参加者")
         excludeSql = self.ifStr(excludeMyself, lambda: "    AND msg.member_id <> %(memberId)s #自分を含まない")
         beforeSql = self.ifStr(beforeTime > 0, lambda: "    AND msg.time < %(beforeTime)s")
+        afterSql = self.ifStr(afterMessageId > 0, lambda: "    AND msg.message_id > %(afterMessageId)s")
         limitSql = self.ifStr(count > 0, lambda: "    LIMIT %(count)s")
         sql = """
-SELECT msgex.message_id, msgex.send_type, msgex.compe_no, msgex.member_id, msgex.time, msgex.message, stp.stamp_url AS stamp
+SELECT msgex.message_id, msgex.send_type, msgex.compe_no, msgex.member_id, msgex.time, msgex.message, stp.stamp_url AS stamp, stp.stamp_id
 FROM (
     SELECT msg.*
     FROM {dbSchema}.t_message msg
     WHERE msg.compe_no = %(compeNo)s
     AND msg.is_delete = false
 {beforeSql}
+{afterSql}
     AND (
         msg.send_type = 1 #ギャラリー含む
 {destSql}
@@ -187,10 +491,10 @@ LEFT JOIN {dbSchema}.m_stamp stp ON (
     AND msgex.stamp_id = stp.stamp_id
 )
 ORDER BY msgex.time ASC, msgex.message_id ASC
-""".replace("{dbSchema}", DB_SCHEMA).replace("{destSql}", destSql).replace("{excludeSql}", excludeSql).replace("{beforeSql}", beforeSql).replace("{limitSql}", limitSql)
+""".replace("{dbSchema}", DB_SCHEMA).replace("{destSql}", destSql).replace("{excludeSql}", excludeSql).replace("{beforeSql}", beforeSql).replace("{afterSql}", afterSql).replace("{limitSql}", limitSql)
 
         messages: list[MessageData] = list()
-        cursor = self.query(sql, { "compeNo": compeNo, "memberId": memberId, "beforeTime": beforeTime, "count": count })
+        cursor = self.query(sql, { "compeNo": compeNo, "memberId": memberId, "beforeTime": beforeTime, "afterMessageId": afterMessageId, "count": count })
         for row in cursor:
             messages.append(GetMessagesData(
                 row["message_id"],
@@ -199,11 +503,87 @@ ORDER BY msgex.time ASC, msgex.message_id ASC
                 row["member_id"],
                 row["time"],
                 row["message"],
-                row["stamp"]
+                row["stamp"],
+                row["stamp_id"]
+                ))
+        return messages
+
+    def findActiveCompeNos(self, sinceTime: int) -> list:
+        """
+        指定時間(1970/1/1UTCからのミリ秒)以降にメッセージのあるコンペ番号を取得する。
+        """
+        sql = """
+SELECT DISTINCT msg.compe_no
+FROM {dbSchema}.t_message msg
+WHERE msg.time >= %(sinceTime)s
+AND msg.is_delete = false
+""".replace("{dbSchema}", DB_SCHEMA)
+        cursor = self.query(sql, { "sinceTime": sinceTime })
+        return [row["compe_no"] for row in cursor]
+
+    def findLatestMessages(self, compeNo: int, count: int, afterMessageId: int = 0) -> list:
+        """
+        対象コンペの新着順からcount件のメッセージを、宛先に関わらず取得する。(時刻の昇順)
+        """
+        afterSql = self.ifStr(afterMessageId > 0, lambda: "    AND msg.message_id > %(afterMessageId)s")
+        sql = """
+SELECT msgex.*
+FROM (
+    SELECT msg.*
+    FROM {dbSchema}.t_message msg
+    WHERE msg.compe_no = %(compeNo)s
+    AND msg.is_delete = false
+{afterSql}
+    ORDER BY msg.time DESC, msg.message_id DESC
+    LIMIT %(count)s
+) msgex
+ORDER BY msgex.time ASC, msgex.message_id ASC
+""".replace("{dbSchema}", DB_SCHEMA).replace("{afterSql}", afterSql)
+        messages: list[SendMessageData] = list()
+        cursor = self.query(sql, { "compeNo": compeNo, "count": count, "afterMessageId": afterMessageId })
+        for row in cursor:
+            messages.append(SendMessageData(
+                row["message_id"],
+                row["send_type"],
+                row["compe_no"],
+                row["dest_member_id"],
+                row["member_id"],
+                row["time"],
+                row["message"],
+                row["stamp_id"],
+                row["is_delete"]
                 ))
         return messages
 
+    def findLastMessageId(self, compeNo: int) -> int:
+        sql = """
+SELECT MAX(msg.message_id) AS message_id
+FROM {dbSchema}.t_message msg
+WHERE msg.compe_no = %(compeNo)s
+""".replace("{dbSchema}", DB_SCHEMA)
+        cursor = self.query(sql, { "compeNo": compeNo })
+        for row in cursor:
+            return row["message_id"] or 0
+        return 0
+
+    def findMessageId(self, compeNo: int, memberId: str, clientMessageId: str) -> int:
+        sql = """
+SELECT msg.message_id
+FROM {dbSchema}.t_message msg
+WHERE msg.compe_no = %(compeNo)s
+AND msg.member_id = %(memberId)s
+AND msg.client_message_id = %(clientMessageId)s
+""".replace("{dbSchema}", DB_SCHEMA)
+        cursor = self.query(sql, { "compeNo": compeNo, "memberId": memberId, "clientMessageId": clientMessageId })
+        for row in cursor:
+            return row["message_id"]
+        return None
+
     def save(self, data: SendMessageData):
+        # client_message_idは指定時のみ登録する。(項目追加前のテーブルでも、未指定の送信は登録できるようにする。)
+        hasClientMessageId = data.client_message_id is not None
+        clientColumnSql = self.ifStr(hasClientMessageId, lambda: ",\n    client_message_id")
+        clientValueSql = self.ifStr(hasClientMessageId, lambda: ",%s")
         sql = """
 INSERT INTO {dbSchema}.t_message (
     send_type,
@@ -213,19 +593,74 @@ INSERT INTO {dbSchema}.t_message (
     time,
     message,
     stamp_id,
-    is_delete
-) VALUES (%s,%s,%s,%s,%s,%s,%s,%s);
-""".replace("{dbSchema}", DB_SCHEMA)
+    is_delete{clientColumnSql}
+) VALUES (%s,%s,%s,%s,%s,%s,%s,%s{clientValueSql});
+""".replace("{dbSchema}", DB_SCHEMA).replace("{clientColumnSql}", clientColumnSql).replace("{clientValueSql}", clientValueSql)
         param = (data.send_type, data.compe_no, data.dest_member_id, data.member_id, data.time, data.message, data.stamp_id, data.is_delete)
+        if hasClientMessageId:
+            param += (data.client_message_id,)
         cur = self.execute(sql, param)
         data.message_id = cur.lastrowid
+        self.router.markWritten(data.member_id)
+
+    def saveAll(self, datas: list):
+        # auto_increment_increment、innodb_autoinc_lock_modeの設定によっては複数行のINSERTのIDが連続しないため、
+        # 同一トランザクション内で1行ずつ登録し、各行のIDを取得する。
+        for data in datas:
+            self.save(data)
 
 @dataclasses.dataclass
 class StampData:
     stamp_id: int
     stamp_url: str
 
-class StampMstRepository(RepositoryBase):
+def createStaticStamps() -> list:
+    """
+    static/stampsの画像からスタンプ一覧を生成する。(sqlite、memoryの初期データ)
+    """
+    stampDir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static", "stamps")
+    stampIds = list()
+    if os.path.isdir(stampDir):
+        for fileName in os.listdir(stampDir):
+            name, ext = os.path.splitext(fileName)
+            if ext == ".png" and name.isnumeric():
+                stampIds.append(int(name))
+    return [StampData(stampId, "/stamps/" + str(stampId) + ".png") for stampId in sorted(stampIds)]
+
+def toStampId(stampId: Any) -> int:
+    if not ValueUtils.isNumeric(stampId):
+        return None
+    return ValueUtils.toInt(stampId)
+
+class StampMstStorage:
+    """
+    スタンプのリポジトリ
+    バックエンド(mysql、sqlite、memory)毎に実装する。
+    """
+    def __init__(self, readOnly: bool = False, memberId: str = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def complete(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def findStamps(self) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def findStamp(self, stampId: int) -> StampData:
+        raise NotImplementedError
+
+class StampMstRepository(RepositoryBase, StampMstStorage):
 
     def findStamps(self) -> list:
         stamps: list[StampData] = list()
@@ -258,5 +693,52 @@ AND stp.stamp_id = %(stampId)s
                 )
         return None
 
+@dataclasses.dataclass
+class RepositoryBackend:
+    open: Any
+    messageDat: type
+    stampMst: type
+
+class RepositoryFactory():
+    """
+    リポジトリ生成
+    config.iniのdb.backendで指定したバックエンドのリポジトリを生成する。
+        mysql: MySQL
+        sqlite: SQLite(WALモード。sqlite.pathのファイル)
+        memory: プロセス内のメモリ(再起動で消去される。)
+    """
+    backend: RepositoryBackend = None
+
+    @staticmethod
+    def getBackend() -> RepositoryBackend:
+        if RepositoryFactory.backend is None:
+            if DB_BACKEND == "mysql":
+                RepositoryFactory.backend = RepositoryBackend(open_pool, MessageDatRepository, StampMstRepository)
+            elif DB_BACKEND == "sqlite":
+                from src.sqlite_repository import open_database, SqliteMessageDatRepository, SqliteStampMstRepository
+                RepositoryFactory.backend = RepositoryBackend(open_database, SqliteMessageDatRepository, SqliteStampMstRepository)
+            elif DB_BACKEND == "memory":
+                from src.memory_repository import open_database, MemoryMessageDatRepository, MemoryStampMstRepository
+                RepositoryFactory.backend = RepositoryBackend(open_database, MemoryMessageDatRepository, MemoryStampMstRepository)
+            else:
+                raise RepositoryException("db.backendが正しくありません:" + DB_BACKEND)
+        return RepositoryFactory.backend
+
+    @staticmethod
+    def open():
+        """
+        バックエンドの初期化(起動時に実行する。)
+        """
+        RepositoryFactory.getBackend().open()
 
+    @staticmethod
+    def createMessageDat(readOnly: bool = False, memberId: str = None) -> MessageDatStorage:
+        """
+        readOnly: 読込のみの場合はTrue(レプリカが設定されている場合はレプリカから読み込む。)
+        memberId: 読み込む会員(直前に書き込んだ会員の場合はプライマリから読み込む。)
+        """
+        return RepositoryFactory.getBackend().messageDat(readOnly, memberId)
 
+    @staticmethod
+    def createStampMst(readOnly: bool = False) -> StampMstStorage:
+        return RepositoryFactory.getBackend().stampMst(readOnly)
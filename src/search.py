@@ -0,0 +1,248 @@
+#coding: UTF-8
+
+import collections
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from src import log
+from src.config import inifile
+from src.enums import ReceptLevel
+from src.repository import RepositoryFactory, SendMessageData, isVisible
+
+# 英数字の単語、あるいは日本語(ひらがな、カタカナ、漢字)の連続
+WORD_PATTERN = re.compile(r"[0-9a-z_]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+
+def normalize(text: str) -> str:
+    """
+    全角英数字・半角カタカナの統一、小文字化を行う。
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+def splitTokens(word: str) -> list:
+    """
+    英数字は単語単位、日本語は2文字単位(bigram)に分割する。(日本語1文字の場合は分割できないため空)
+    """
+    if word.isascii():
+        return [word]
+    return [word[index:index + 2] for index in range(len(word) - 1)]
+
+def tokenize(text: str) -> set:
+    tokens = set()
+    if not text:
+        return tokens
+    for word in WORD_PATTERN.findall(normalize(text)):
+        tokens.update(splitTokens(word))
+    return tokens
+
+class CompeIndex:
+    """
+    コンペ毎の検索索引
+    保持するメッセージはmaxMessages件までとし、超過した場合はメッセージIDの小さいメッセージから除外する。
+    Attributes:
+    datas(dict(int, SendMessageData)):メッセージID毎のメッセージ
+    messageIds(list(int)):保持しているメッセージID(除外順のヒープ)
+    tokenMap(dict(str, set(int))):語毎のメッセージID
+    memberMap(dict(str, set(int))):送信者の会員ID毎のメッセージID
+    syncedMessageId(int):DBから読み込んだ最新(最大)のメッセージID
+    checkedTime(float):DBから読み込んだ時刻(time.monotonic)
+    builtTime(float):索引を作成した時刻(time.monotonic)
+    """
+    def __init__(self, maxMessages: int):
+        self.maxMessages = maxMessages
+        self.datas = dict()
+        self.messageIds = list()
+        self.tokenMap = dict()
+        self.memberMap = dict()
+        self.syncedMessageId = 0
+        self.checkedTime = time.monotonic()
+        self.builtTime = self.checkedTime
+
+    def sync(self, datas: list):
+        """
+        DBから読み込んだメッセージを追加する。
+        """
+        for data in datas:
+            self.add(data)
+            self.syncedMessageId = max(self.syncedMessageId, data.message_id)
+
+    def add(self, data: SendMessageData):
+        if data.is_delete or data.message_id in self.datas:
+            return
+        messageId = data.message_id
+        self.datas[messageId] = data
+        for token in tokenize(data.message):
+            self.tokenMap.setdefault(token, set()).add(messageId)
+        self.memberMap.setdefault(data.member_id, set()).add(messageId)
+        heapq.heappush(self.messageIds, messageId)
+        while len(self.datas) > self.maxMessages:
+            self.remove(heapq.heappop(self.messageIds))
+
+    def remove(self, messageId: int):
+        data = self.datas.pop(messageId)
+        for token in tokenize(data.message):
+            self.discard(self.tokenMap, token, messageId)
+        self.discard(self.memberMap, data.member_id, messageId)
+
+    def discard(self, indexMap: dict, key: str, messageId: int):
+        messageIds = indexMap.get(key)
+        if messageIds is None:
+            return
+        messageIds.discard(messageId)
+        if len(messageIds) == 0:
+            del indexMap[key]
+
+    def search(self, keyword: str, senderId: str, receptLevel: ReceptLevel, memberId: str, beforeMessageId: int, count: int) -> list:
+        """
+        キーワード(英数字は単語の一致、日本語は部分一致)と送信者で検索し、
+        閲覧できるメッセージを新しい順にcount件返す。(beforeMessageIdより前に制限する。0以下の場合は制限しない。)
+        """
+        candidates = list()
+        words = list()
+        if keyword:
+            words = WORD_PATTERN.findall(normalize(keyword))
+            for word in words:
+                for token in splitTokens(word):
+                    candidates.append(self.tokenMap.get(token, set()))
+        if senderId is not None:
+            candidates.append(self.memberMap.get(senderId, set()))
+        if len(candidates) > 0:
+            candidates.sort(key=len)
+            messageIds = set(candidates[0]).intersection(*candidates[1:])
+        else:
+            messageIds = self.datas.keys()
+        # bigramの一致は連続していることを保証しないため、日本語は本文で確認する。
+        phrases = [word for word in words if not word.isascii()]
+        results = list()
+        for messageId in sorted(messageIds, reverse=True):
+            if beforeMessageId > 0 and messageId >= beforeMessageId:
+                continue
+            data = self.datas[messageId]
+            if not isVisible(data, receptLevel, memberId):
+                continue
+            if len(phrases) > 0:
+                text = normalize(data.message or "")
+                if not all(phrase in text for phrase in phrases):
+                    continue
+            results.append(data)
+            if len(results) >= count:
+                break
+        return results
+
+class SearchIndexManager():
+    """
+    メッセージの検索索引
+    コンペ毎の索引は最初の検索時にDBから作成し、以降はSendMessageServiceで送信されたメッセージを追加する。
+    他プロセス(複数ワーカー、再起動時の旧プロセス)から送信されたメッセージを反映するため、
+    refreshSeconds経過後の検索時にDBから読み込んだ最新のメッセージID以降を追加で読み込む。
+    追加の読込では反映できない変更(他プロセスでの削除、小さいIDの遅れたコミット)を反映するため、
+    作成からrebuildSeconds経過後の検索時は索引を作成し直す。
+    索引を保持するコンペはmaxCompes件までとし、超過した場合は最も長く検索されていないコンペの索引を破棄する。
+    (サービス実行スレッドから参照されるため、lockで保護する。)
+    """
+    logger = log.getLog(__name__)
+    lock = threading.RLock()
+    # 索引の作成(DBの読込)は1件ずつ行う。
+    buildLock = threading.Lock()
+    maxCompes = inifile.getint('search', 'maxCompes', fallback=100)
+    maxMessages = inifile.getint('search', 'maxMessages', fallback=5000)
+    refreshSeconds = inifile.getfloat('search', 'refreshSeconds', fallback=2)
+    rebuildSeconds = inifile.getfloat('search', 'rebuildSeconds', fallback=60)
+    indexes = collections.OrderedDict()
+    # 索引の作成中(作成し直しを含む)に送信されたメッセージ
+    pending = dict()
+
+    @staticmethod
+    def getIndex(compeNo: int) -> CompeIndex:
+        with SearchIndexManager.lock:
+            index = SearchIndexManager.indexes.get(compeNo)
+            if index is not None:
+                SearchIndexManager.indexes.move_to_end(compeNo)
+                now = time.monotonic()
+                if now - index.checkedTime < SearchIndexManager.refreshSeconds:
+                    return index
+                # 読込は1スレッドのみ行い、他のスレッドは読込済みとして扱う。
+                index.checkedTime = now
+                syncedMessageId = index.syncedMessageId
+                isExpired = now - index.builtTime >= SearchIndexManager.rebuildSeconds
+        if index is not None and not isExpired:
+            return SearchIndexManager.refresh(compeNo, index, syncedMessageId)
+        return SearchIndexManager.build(compeNo, index)
+
+    @staticmethod
+    def build(compeNo: int, current: CompeIndex) -> CompeIndex:
+        """
+        DBから索引を作成する。
+        current: 作成し直す索引(作成中は他のスレッドはこの索引で検索し、読込エラーの場合はこの索引で検索する。)
+        """
+        with SearchIndexManager.buildLock:
+            with SearchIndexManager.lock:
+                index = SearchIndexManager.indexes.get(compeNo)
+                if index is not None and index is not current:
+                    return index
+                SearchIndexManager.pending[compeNo] = list()
+            try:
+                with RepositoryFactory.createMessageDat(True) as messageDat:
+                    datas = messageDat.findLatestMessages(compeNo, SearchIndexManager.maxMessages)
+            except Exception as ex:
+                with SearchIndexManager.lock:
+                    SearchIndexManager.pending.pop(compeNo, None)
+                if current is None:
+                    raise
+                if log.isWarning():
+                    SearchIndexManager.logger.warning("search index rebuild error compe_no:" + str(compeNo) + ", " + str(ex))
+                return current
+            with SearchIndexManager.lock:
+                index = CompeIndex(SearchIndexManager.maxMessages)
+                index.sync(datas)
+                for data in SearchIndexManager.pending.pop(compeNo):
+                    index.add(data)
+                indexes = SearchIndexManager.indexes
+                indexes[compeNo] = index
+                indexes.move_to_end(compeNo)
+                while len(indexes) > SearchIndexManager.maxCompes:
+                    evictedCompeNo, _ = indexes.popitem(last=False)
+                    if log.isDebug():
+                        SearchIndexManager.logger.debug("search index evicted compe_no:" + str(evictedCompeNo))
+            if log.isDebug():
+                SearchIndexManager.logger.debug("search index built compe_no:" + str(compeNo) + ", messages:" + str(len(index.datas)))
+            return index
+
+    @staticmethod
+    def refresh(compeNo: int, index: CompeIndex, syncedMessageId: int) -> CompeIndex:
+        """
+        DBから読み込んだ最新のメッセージID以降を索引に追加する。(読込エラーの場合は現在の索引で検索する。)
+        """
+        try:
+            with RepositoryFactory.createMessageDat(True) as messageDat:
+                datas = messageDat.findLatestMessages(compeNo, SearchIndexManager.maxMessages, syncedMessageId)
+        except Exception as ex:
+            if log.isWarning():
+                SearchIndexManager.logger.warning("search index refresh error compe_no:" + str(compeNo) + ", " + str(ex))
+            return index
+        with SearchIndexManager.lock:
+            index.sync(datas)
+        if log.isDebug():
+            SearchIndexManager.logger.debug("search index refreshed compe_no:" + str(compeNo) + ", messages:" + str(len(datas)))
+        return index
+
+    @staticmethod
+    def add(data: SendMessageData):
+        with SearchIndexManager.lock:
+            index = SearchIndexManager.indexes.get(data.compe_no)
+            if index is not None:
+                index.add(data)
+            if data.compe_no in SearchIndexManager.pending:
+                SearchIndexManager.pending[data.compe_no].append(data)
+
+    @staticmethod
+    def search(compeNo: int, keyword: str, senderId: str, receptLevel: ReceptLevel, memberId: str, beforeMessageId: int, count: int) -> list:
+        index = SearchIndexManager.getIndex(compeNo)
+        with SearchIndexManager.lock:
+            return index.search(keyword, senderId, receptLevel, memberId, beforeMessageId, count)
+
+    @staticmethod
+    def countMessages() -> int:
+        with SearchIndexManager.lock:
+            return sum(len(index.datas) for index in SearchIndexManager.indexes.values())
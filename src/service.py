@@ -1,11 +1,15 @@
 import dataclasses
 from abc import abstractmethod
-from src.data import ServerResult, Serializable
+from src.data import ServerResult, Serializable, CompactMessages
+from src.codec import EncodedResult
+from src.cache import MessageCache, StampCache, SentMessageCache, toGetMessagesData
+from src.search import SearchIndexManager, WORD_PATTERN, normalize
+from src.trace import Tracer
 from typing import TypeVar, Generic, Any
 from src.util import ValueUtils
 from src.manager import SessionManager, SessionInfo
 from src.enums import ResultStatus, SendType, MethodType, ReceptLevel
-from src.repository import MessageDatRepository, StampMstRepository, SendMessageData
+from src.repository import RepositoryFactory, SendMessageData, GetMessagesData, StampData, DuplicateKeyException
 from src import log
 
 class ValidationInfo:
@@ -42,6 +46,12 @@ class ServiceBase(Generic[P]):
     def getSessionInfo(self, session) -> SessionInfo:
         return SessionManager.getSessionInfoFromId(session.id)
 
+    def getReceptLevel(self, sessionInfo: SessionInfo, compeNo: int) -> ReceptLevel:
+        """
+        対象コンペの受信レベルを取得する。(受信していないコンペの場合はNone)
+        """
+        return sessionInfo.subscriptions.get(compeNo)
+
     @abstractmethod
     def validate(self, clientForm: object) -> ValidationInfo:
         """
@@ -68,6 +78,7 @@ class InitParam:
     compe_no: int
     member_id: str
     recept_level: ReceptLevel = ReceptLevel.Gallery
+    compact: bool = False
 
 class InitService(ServiceBase[InitParam]):
 
@@ -97,19 +108,176 @@ class InitService(ServiceBase[InitParam]):
         return InitParam(
                 ValueUtils.getInt(form, "compe_no"),
                 str(form["member_id"]),
-                ReceptLevel.parse(ValueUtils.toInt(form["recept_level"]))
+                ReceptLevel.parse(ValueUtils.toInt(form["recept_level"])),
+                ValueUtils.getBool(form, "compact")
                 )
 
     def execute(self, sessionInfo: SessionInfo, param: InitParam) -> ServerResult:
         sessionInfo.compeNo = param.compe_no
         sessionInfo.memberId = param.member_id
         sessionInfo.receptLevel = param.recept_level
+        sessionInfo.compact = param.compact
         SessionManager.addSession(sessionInfo);
         return ServerResult.fromStatus(ResultStatus.Success);
 
+def validateCompeNo(info: ValidationInfo, form: dict):
+    """
+    任意項目のcompe_no(省略時はinit時のコンペ)を検証する。
+    """
+    compeNo = ValueUtils.getStr(form, "compe_no")
+    if compeNo is not None and not ValueUtils.isNumeric(compeNo):
+        info.addError("compe_noは数値を設定してください。");
+
+@dataclasses.dataclass
+class SubscribeParam:
+    compe_no: int
+    recept_level: ReceptLevel = ReceptLevel.Gallery
+
+class SubscribeService(ServiceBase[SubscribeParam]):
+    """
+    コンペ受信追加
+    init時のコンペに加えて、指定したコンペのメッセージを受信する。(受信済みの場合は受信レベルを変更する。)
+    """
+
+    def validate(self, clientForm: object) -> ValidationInfo:
+        info = ValidationInfo(self)
+        form = ValueUtils.getAny(clientForm, "subscribe")
+        if form is None:
+            return info.addError("subscribeパラメータは必須です。")
+        compeNo = ValueUtils.getStr(form, "compe_no")
+        if compeNo is None:
+            info.addError("compe_noは必須です。")
+        elif not ValueUtils.isNumeric(compeNo):
+            info.addError("compe_noは数値を設定してください。");
+        receptLevel = ReceptLevel.parse(ValueUtils.getInt(form, "recept_level"))
+        if receptLevel is None:
+            info.addError("recept_levelは必須です。")
+        return info.valid();
+
+    def createParam(self, clientForm: object) -> SubscribeParam:
+        form = clientForm["subscribe"]
+        return SubscribeParam(
+                ValueUtils.getInt(form, "compe_no"),
+                ReceptLevel.parse(ValueUtils.toInt(form["recept_level"]))
+                )
+
+    def execute(self, sessionInfo: SessionInfo, param: SubscribeParam) -> ServerResult:
+        SessionManager.subscribe(sessionInfo, param.compe_no, param.recept_level)
+        if param.compe_no == sessionInfo.compeNo:
+            sessionInfo.receptLevel = param.recept_level
+        return ServerResult.fromStatus(ResultStatus.Success)
+
+@dataclasses.dataclass
+class UnsubscribeParam:
+    compe_no: int
+
+class UnsubscribeService(ServiceBase[UnsubscribeParam]):
+    """
+    コンペ受信解除
+    init時のコンペは解除できない。(再initで変更する。)
+    """
+
+    def validate(self, clientForm: object) -> ValidationInfo:
+        info = ValidationInfo(self)
+        form = ValueUtils.getAny(clientForm, "unsubscribe")
+        if form is None:
+            return info.addError("unsubscribeパラメータは必須です。")
+        compeNo = ValueUtils.getStr(form, "compe_no")
+        if compeNo is None:
+            info.addError("compe_noは必須です。")
+        elif not ValueUtils.isNumeric(compeNo):
+            info.addError("compe_noは数値を設定してください。");
+        return info.valid();
+
+    def createParam(self, clientForm: object) -> UnsubscribeParam:
+        form = clientForm["unsubscribe"]
+        return UnsubscribeParam(ValueUtils.getInt(form, "compe_no"))
+
+    def execute(self, sessionInfo: SessionInfo, param: UnsubscribeParam) -> ServerResult:
+        if param.compe_no == sessionInfo.compeNo:
+            return ServerResult.fromStatus(ResultStatus.ValidationError)
+        SessionManager.unsubscribe(sessionInfo, param.compe_no)
+        return ServerResult.fromStatus(ResultStatus.Success)
+
+def createMessagesResult(sessionInfo: SessionInfo, compeNo: int, datas: list) -> ServerResult:
+    """
+    メッセージ一覧の返却値を生成する。
+    init時にcompactを指定したセッションには短縮形式(CompactMessages)で返却する。
+    """
+    result = ServerResult.fromStatus(ResultStatus.Success)
+    if sessionInfo.compact:
+        CompactMessages.setMessages(result, compeNo, datas)
+        return result
+    messages = list()
+    for data in datas:
+        message = Serializable()
+        message.send_type = data.send_type
+        message.message_id = data.message_id
+        message.compe_no = data.compe_no
+        message.member_id = data.member_id
+        message.time = data.time
+        message.message = data.message
+        message.stamp = data.stamp
+        messages.append(message)
+    result.messages = messages
+    return result
+
+class PushMessage:
+    """
+    送信されたメッセージの他セッションへの通知(GetMessagesFromSend)
+    送信形式(通常、短縮形式)毎に1回だけ生成・変換する。
+    """
+    def __init__(self, data: SendMessageData, stamp: StampData):
+        self.data = data
+        self.stamp = stamp
+        self.normal = None
+        self.compact = None
+
+    def get(self, sessionInfo: SessionInfo) -> EncodedResult:
+        if sessionInfo.compact:
+            if self.compact is None:
+                self.compact = EncodedResult(self.createCompactResult())
+            return self.compact
+        if self.normal is None:
+            self.normal = EncodedResult(self.createResult())
+        return self.normal
+
+    def createResult(self) -> ServerResult:
+        data = self.data
+        message = Serializable()
+        message.send_type = data.send_type
+        message.message_id = data.message_id
+        message.compe_no = data.compe_no
+        message.member_id = data.member_id
+        message.time = data.time
+        message.message = data.message
+        if self.stamp is not None:
+            message.stamp = self.stamp.stamp_url
+        result = ServerResult.fromAll(MethodType.GetMessagesFromSend, ResultStatus.Success)
+        result.messages = [message]
+        return result
+
+    def createCompactResult(self) -> ServerResult:
+        data = self.data
+        stamp = self.stamp
+        result = ServerResult.fromAll(MethodType.GetMessagesFromSend, ResultStatus.Success)
+        CompactMessages.setMessages(result, data.compe_no, [GetMessagesData(
+                data.message_id,
+                data.send_type,
+                data.compe_no,
+                data.member_id,
+                data.time,
+                data.message,
+                None if stamp is None else stamp.stamp_url,
+                None if stamp is None else stamp.stamp_id
+                )])
+        return result
+
 @dataclasses.dataclass
 class GetNewMessagesParam:
     count: int
+    after_message_id: int = 0
+    compe_no: int = None
 
 class GetNewMessagesService(ServiceBase[GetNewMessagesParam]):
 
@@ -123,36 +291,39 @@ class GetNewMessagesService(ServiceBase[GetNewMessagesParam]):
             info.addError("countは必須です。");
         elif not ValueUtils.isNumeric(count):
             info.addError("countは数値を設定してください。");
+        afterMessageId = ValueUtils.getStr(form, "after_message_id")
+        if afterMessageId is not None and not ValueUtils.isNumeric(afterMessageId):
+            info.addError("after_message_idは数値を設定してください。");
+        validateCompeNo(info, form)
         return info.valid();
 
     def createParam(self, clientForm: object) -> GetNewMessagesParam:
         form = clientForm["get_new_messages"]
         return GetNewMessagesParam(
-                ValueUtils.getInt(form, "count")
+                ValueUtils.getInt(form, "count"),
+                ValueUtils.getInt(form, "after_message_id") or 0,
+                ValueUtils.getInt(form, "compe_no")
                 )
 
     def execute(self, sessionInfo: SessionInfo, param: GetNewMessagesParam) -> ServerResult:
-        messages = list()
-        with MessageDatRepository() as messageDat:
-            datas = messageDat.findMessages(sessionInfo.receptLevel, 0, param.count, sessionInfo.compeNo, sessionInfo.memberId, True)
-            for data in datas:
-                message = Serializable()
-                message.send_type = data.send_type
-                message.message_id = data.message_id
-                message.compe_no = data.compe_no
-                message.member_id = data.member_id
-                message.time = data.time
-                message.message = data.message
-                message.stamp = data.stamp
-                messages.append(message)
-        result = ServerResult.fromStatus(ResultStatus.Success)
-        result.messages = messages
-        return result
+        compeNo = param.compe_no or sessionInfo.compeNo
+        receptLevel = self.getReceptLevel(sessionInfo, compeNo)
+        if receptLevel is None:
+            return ServerResult.fromStatus(ResultStatus.ValidationError)
+        # after_message_idを指定した場合は、クライアントが保持済みのメッセージを除外する。
+        with Tracer.span("cache"):
+            datas = MessageCache.findMessages(receptLevel, 0, param.count, compeNo, sessionInfo.memberId, True, param.after_message_id)
+        if datas is None:
+            with RepositoryFactory.createMessageDat(True, sessionInfo.memberId) as messageDat:
+                datas = messageDat.findMessages(receptLevel, 0, param.count, compeNo, sessionInfo.memberId, True, param.after_message_id)
+        with Tracer.span("createResult"):
+            return createMessagesResult(sessionInfo, compeNo, datas)
 
 @dataclasses.dataclass
 class GetMessagesParam:
     before_time: int
     count: int
+    compe_no: int = None
 
 class GetMessagesService(ServiceBase[GetMessagesParam]):
 
@@ -171,32 +342,29 @@ class GetMessagesService(ServiceBase[GetMessagesParam]):
             info.addError("countは必須です。");
         elif not ValueUtils.isNumeric(count):
             info.addError("countは数値を設定してください。");
+        validateCompeNo(info, form)
         return info.valid();
 
     def createParam(self, clientForm: object) -> GetMessagesParam:
         form = clientForm["get_messages"]
         return GetMessagesParam(
                 ValueUtils.getInt(form, "before_time"),
-                ValueUtils.getInt(form, "count")
+                ValueUtils.getInt(form, "count"),
+                ValueUtils.getInt(form, "compe_no")
                 )
 
     def execute(self, sessionInfo: SessionInfo, param: GetMessagesParam) -> ServerResult:
-        messages = list()
-        with MessageDatRepository() as messageDat:
-            datas = messageDat.findMessages(sessionInfo.receptLevel, param.before_time, param.count, sessionInfo.compeNo, sessionInfo.memberId, False)
-            for data in datas:
-                message = Serializable()
-                message.send_type = data.send_type
-                message.message_id = data.message_id
-                message.compe_no = data.compe_no
-                message.member_id = data.member_id
-                message.time = data.time
-                message.message = data.message
-                message.stamp = data.stamp
-                messages.append(message)
-        result = ServerResult.fromStatus(ResultStatus.Success)
-        result.messages = messages
-        return result
+        compeNo = param.compe_no or sessionInfo.compeNo
+        receptLevel = self.getReceptLevel(sessionInfo, compeNo)
+        if receptLevel is None:
+            return ServerResult.fromStatus(ResultStatus.ValidationError)
+        with Tracer.span("cache"):
+            datas = MessageCache.findMessages(receptLevel, param.before_time, param.count, compeNo, sessionInfo.memberId, False)
+        if datas is None:
+            with RepositoryFactory.createMessageDat(True, sessionInfo.memberId) as messageDat:
+                datas = messageDat.findMessages(receptLevel, param.before_time, param.count, compeNo, sessionInfo.memberId, False)
+        with Tracer.span("createResult"):
+            return createMessagesResult(sessionInfo, compeNo, datas)
 
 @dataclasses.dataclass
 class SendMessageParam:
@@ -204,6 +372,8 @@ class SendMessageParam:
     dest_member_id: str
     message: str
     stamp_id: str
+    compe_no: int = None
+    client_message_id: str = None
 
 class SendMessageService(ServiceBase[SendMessageParam]):
     logger = log.getLog(__name__)
@@ -229,6 +399,10 @@ class SendMessageService(ServiceBase[SendMessageParam]):
         elif sendType == SendType.User:
             if destMemberId is None:
                 return info.addError("ユーザー指定で送信する場合は、send_message.dest_member_idは必須です。")
+        validateCompeNo(info, form)
+        clientMessageId = ValueUtils.getStr(form, "client_message_id")
+        if clientMessageId is not None and len(clientMessageId) > 64:
+            info.addError("client_message_idは64文字以内で設定してください。")
         return info.valid();
 
     def createParam(self, clientForm: object) -> SendMessageParam:
@@ -237,12 +411,22 @@ class SendMessageService(ServiceBase[SendMessageParam]):
                 SendType.parse(ValueUtils.getInt(form, "send_type")),
                 ValueUtils.getStr(form, "dest_member_id"),
                 ValueUtils.getStr(form, "message"),
-                ValueUtils.getStr(form, "stamp_id")
+                ValueUtils.getStr(form, "stamp_id"),
+                ValueUtils.getInt(form, "compe_no"),
+                ValueUtils.getStr(form, "client_message_id")
                 )
 
     def execute(self, sessionInfo: SessionInfo, param: SendMessageParam) -> ServerResult:
-        compeNo = sessionInfo.compeNo
+        compeNo = param.compe_no or sessionInfo.compeNo
+        if self.getReceptLevel(sessionInfo, compeNo) is None:
+            return ServerResult.fromStatus(ResultStatus.ValidationError)
         memberId = sessionInfo.memberId
+        clientMessageId = param.client_message_id
+        if clientMessageId is not None:
+            # 再送の場合は登録・配信を行わず、登録済みのメッセージIDを返却する。
+            messageId = SentMessageCache.find(compeNo, memberId, clientMessageId)
+            if messageId is not None:
+                return self.createDuplicateResult(messageId, clientMessageId)
         sendType = param.send_type
         destMemberId = param.dest_member_id
         data = SendMessageData(
@@ -254,45 +438,120 @@ class SendMessageService(ServiceBase[SendMessageParam]):
                 ValueUtils.getTimeInMillis(),
                 param.message,
                 param.stamp_id,
-                False
+                False,
+                clientMessageId
                 )
-        with MessageDatRepository() as messageRepository:
-            messageRepository.save(data);
-        message = Serializable()
-        message.send_type = data.send_type
-        message.message_id = data.message_id
-        message.compe_no = data.compe_no
-        message.member_id = data.member_id
-        message.time = data.time
-        message.message = data.message
-        with StampMstRepository() as stampRepository:
-            stamp = stampRepository.findStamp(data.stamp_id)
-            if stamp is not None:
-                message.stamp = stamp.stamp_url
-        otherResult = ServerResult.fromStatus(ResultStatus.Success)
-        otherResult.messages = list()
-        otherResult.messages.append(message)
-        methodType = MethodType.GetMessagesFromSend
-        otherResult.method = methodType.value
-        otherMessage = otherResult.toJson()
-        sendList: list[SessionInfo]
-        if sendType == SendType.User:
-            # 個人宛の場合、送信者と宛先のみ
-            sendList = [
-                SessionManager.getSessionInfo(compeNo, memberId),
-                SessionManager.getSessionInfo(compeNo, destMemberId)
-                ]
-        elif sendType == SendType.All:
-            sendList = SessionManager.getSessionInfos(compeNo)
-        else:
-            sendList = filter(lambda it:it.receptLevel == ReceptLevel.All, SessionManager.getSessionInfos(compeNo))
-        for info in sendList:
-            if info is None:
-                continue
-            info.session.write_message(otherMessage)
-            if log.isDebug():
-                self.logger.debug("Send message to others sessions id:" + info.session.id)
-        return ServerResult.fromStatus(ResultStatus.Success)
+        try:
+            with Tracer.span("save"):
+                with RepositoryFactory.createMessageDat() as messageRepository:
+                    messageRepository.save(data);
+        except DuplicateKeyException:
+            if clientMessageId is None:
+                raise
+            # 重複判定の保持範囲外、あるいは同時に再送された場合
+            with RepositoryFactory.createMessageDat() as messageRepository:
+                messageId = messageRepository.findMessageId(compeNo, memberId, clientMessageId)
+            SentMessageCache.add(compeNo, memberId, clientMessageId, messageId)
+            return self.createDuplicateResult(messageId, clientMessageId)
+        if clientMessageId is not None:
+            SentMessageCache.add(compeNo, memberId, clientMessageId, data.message_id)
+        MessageCache.add(data)
+        SearchIndexManager.add(data)
+        with Tracer.span("findStamp"):
+            stamp = StampCache.findStamp(data.stamp_id)
+        pushMessage = PushMessage(data, stamp)
+        with Tracer.span("fanout"):
+            # 送信先はコンペ毎・送信タイプ毎に作成済みの一覧を参照する。
+            sendList: tuple
+            if sendType == SendType.User:
+                # 個人宛の場合、送信者と宛先のみ
+                sendList = SessionManager.getMemberSessionInfos(compeNo, memberId)
+                if destMemberId != memberId:
+                    sendList = sendList + SessionManager.getMemberSessionInfos(compeNo, destMemberId)
+            elif sendType == SendType.All:
+                sendList = SessionManager.getSessionInfos(compeNo)
+            else:
+                sendList = SessionManager.getParticipantSessionInfos(compeNo)
+            for info in sendList:
+                info.session.writeResult(pushMessage.get(info))
+                if log.isDebug():
+                    self.logger.debug("Send message to others sessions id:" + info.session.id)
+        result = ServerResult.fromStatus(ResultStatus.Success)
+        result.message_id = data.message_id
+        return result
+
+    def createDuplicateResult(self, messageId: int, clientMessageId: str) -> ServerResult:
+        if log.isInfo():
+            self.logger.info("再送メッセージ client_message_id:" + clientMessageId + ", message_id:" + str(messageId))
+        result = ServerResult.fromStatus(ResultStatus.Success)
+        result.message_id = messageId
+        return result
+
+@dataclasses.dataclass
+class SearchMessagesParam:
+    keyword: str
+    member_id: str
+    count: int
+    before_message_id: int = 0
+    compe_no: int = None
+
+class SearchMessagesService(ServiceBase[SearchMessagesParam]):
+    """
+    メッセージ検索
+    キーワード(英数字は単語の一致、日本語は部分一致)、送信者の会員IDで検索し、新しい順にcount件返す。
+    続きがある場合はnext_before_message_idを返す。(次回のbefore_message_idに指定する。)
+    """
+    maxCount = 100
+
+    def validate(self, clientForm: object) -> ValidationInfo:
+        info = ValidationInfo(self)
+        form = ValueUtils.getAny(clientForm, "search_messages")
+        if form is None:
+            return info.addError("search_messagesパラメータは必須です。")
+        keyword = ValueUtils.getStr(form, "keyword")
+        memberId = ValueUtils.getStr(form, "member_id")
+        if ValueUtils.isEmpty(keyword) and ValueUtils.isEmpty(memberId):
+            info.addError("keywordとmember_idのいずれかが必須です。")
+        elif not ValueUtils.isEmpty(keyword) and len(WORD_PATTERN.findall(normalize(keyword))) == 0:
+            info.addError("keywordに検索できる文字(英数字、日本語)を含めてください。")
+        count = ValueUtils.getStr(form, "count")
+        if count is None:
+            info.addError("countは必須です。")
+        elif not ValueUtils.isNumeric(count):
+            info.addError("countは数値を設定してください。")
+        elif not 0 < ValueUtils.toInt(count) <= SearchMessagesService.maxCount:
+            info.addError("countは1から" + str(SearchMessagesService.maxCount) + "の範囲で設定してください。")
+        beforeMessageId = ValueUtils.getStr(form, "before_message_id")
+        if beforeMessageId is not None and not ValueUtils.isNumeric(beforeMessageId):
+            info.addError("before_message_idは数値を設定してください。")
+        validateCompeNo(info, form)
+        return info.valid();
+
+    def createParam(self, clientForm: object) -> SearchMessagesParam:
+        form = clientForm["search_messages"]
+        return SearchMessagesParam(
+                ValueUtils.getStr(form, "keyword"),
+                ValueUtils.getStr(form, "member_id"),
+                ValueUtils.getInt(form, "count"),
+                ValueUtils.getInt(form, "before_message_id") or 0,
+                ValueUtils.getInt(form, "compe_no")
+                )
+
+    def execute(self, sessionInfo: SessionInfo, param: SearchMessagesParam) -> ServerResult:
+        compeNo = param.compe_no or sessionInfo.compeNo
+        receptLevel = self.getReceptLevel(sessionInfo, compeNo)
+        if receptLevel is None:
+            return ServerResult.fromStatus(ResultStatus.ValidationError)
+        # 続きの有無の判定のため、1件多く取得する。
+        with Tracer.span("search"):
+            datas = SearchIndexManager.search(compeNo, param.keyword, param.member_id, receptLevel, sessionInfo.memberId, param.before_message_id, param.count + 1)
+        hasNext = len(datas) > param.count
+        datas = datas[:param.count]
+        with Tracer.span("createResult"):
+            datas.reverse()
+            result = createMessagesResult(sessionInfo, compeNo, [toGetMessagesData(data) for data in datas])
+        result.next_before_message_id = datas[0].message_id if hasNext else None
+        return result
 
 class GetStampsService(ServiceBase[Any]):
     def validate(self, clientForm: object) -> ValidationInfo:
@@ -303,13 +562,12 @@ class GetStampsService(ServiceBase[Any]):
 
     def execute(self, sessionInfo: SessionInfo, param: Any) -> ServerResult:
         stamps = list()
-        with StampMstRepository() as stampMst:
-            datas = stampMst.findStamps()
-            for data in datas:
-                stamp = Serializable()
-                stamp.stamp_id = data.stamp_id
-                stamp.stamp_url = data.stamp_url
-                stamps.append(stamp)
+        datas = StampCache.findStamps()
+        for data in datas:
+            stamp = Serializable()
+            stamp.stamp_id = data.stamp_id
+            stamp.stamp_url = data.stamp_url
+            stamps.append(stamp)
         result = ServerResult.fromStatus(ResultStatus.Success)
         result.stamps = stamps
         return result
@@ -0,0 +1,305 @@
+#coding: UTF-8
+
+import sqlite3
+from typing import Any
+from src import log
+from src.config import inifile
+from src.enums import ReceptLevel
+from src.repository import RepositoryBase, RepositoryException, DuplicateKeyException, MessageDatStorage, StampMstStorage, SendMessageData, GetMessagesData, StampData,\
+    ReplicaRouter, createStaticStamps, parseList
+
+SQLITE_PATH = inifile.get('sqlite', 'path', fallback='./golferweb-chat.db')
+SQLITE_TIMEOUT = inifile.getint('sqlite', 'timeout', fallback=5)
+
+sqliteReplicaRouter = ReplicaRouter(parseList(inifile.get('sqlite', 'replicaPaths', fallback='')))
+
+def get_connection(path: str = SQLITE_PATH, readOnly: bool = False) -> sqlite3.Connection:
+    if readOnly:
+        # レプリカは読込専用で開く。(ファイルが存在しない場合はエラー)
+        conn = sqlite3.connect("file:" + path + "?mode=ro", timeout=SQLITE_TIMEOUT, check_same_thread=False, uri=True)
+    else:
+        conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+def open_database(path: str = SQLITE_PATH):
+    """
+    WALモードの設定、テーブルの作成、スタンプの初期データ登録を行う。
+    """
+    conn = get_connection(path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript("""
+CREATE TABLE IF NOT EXISTS t_message (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    send_type INTEGER NOT NULL,
+    compe_no INTEGER NOT NULL,
+    dest_member_id TEXT,
+    member_id TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    message TEXT,
+    stamp_id INTEGER,
+    is_delete INTEGER NOT NULL DEFAULT 0,
+    client_message_id TEXT
+);
+CREATE INDEX IF NOT EXISTS t_message_compe_time ON t_message (compe_no, time, message_id);
+CREATE INDEX IF NOT EXISTS t_message_time ON t_message (time);
+CREATE TABLE IF NOT EXISTS m_stamp (
+    stamp_id INTEGER PRIMARY KEY,
+    stamp_url TEXT NOT NULL,
+    is_delete INTEGER NOT NULL DEFAULT 0
+);
+""")
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(t_message)")]
+        if "client_message_id" not in columns:
+            # 既存のデータベースへの項目追加
+            conn.execute("ALTER TABLE t_message ADD COLUMN client_message_id TEXT")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS t_message_client ON t_message (compe_no, member_id, client_message_id)")
+        if conn.execute("SELECT COUNT(*) FROM m_stamp").fetchone()[0] == 0:
+            conn.executemany("INSERT INTO m_stamp (stamp_id, stamp_url) VALUES (?, ?)",
+                    [(stamp.stamp_id, stamp.stamp_url) for stamp in createStaticStamps()])
+        conn.commit()
+    except Exception as e:
+        raise RepositoryException(*e.args)
+    finally:
+        conn.close()
+
+class SqliteRepositoryBase(RepositoryBase):
+    """
+    SQLiteリポジトリの基底クラス
+    接続・トランザクション、レプリカの振分けはRepositoryBaseと同じ。(レプリカはsqlite.replicaPathsのファイル)
+    """
+    logger = log.getLog(__name__)
+    router: ReplicaRouter = sqliteReplicaRouter
+    conn: sqlite3.Connection
+    path: str = SQLITE_PATH
+
+    def openConnection(self, replica: str) -> sqlite3.Connection:
+        if replica is None:
+            return get_connection(self.path)
+        return get_connection(replica, True)
+
+    def querySql(self, sql: str, param: Any = ()) -> Any:
+        try:
+            cur = self.conn.execute(sql, param)
+            if log.isDebug():
+                self.logger.debug("sql:" + sql)
+            return cur
+        except Exception as e:
+            raise RepositoryException(*e.args)
+
+    def executeSql(self, sql: str, param: Any = ()) -> Any:
+        try:
+            self.useTransaction = True
+            cur = self.conn.execute(sql, param)
+            if log.isDebug():
+                self.logger.debug("sql:" + sql)
+            self.isComplete = True
+            return cur
+        except Exception as e:
+            self.isComplete = False
+            if isinstance(e, sqlite3.IntegrityError) and "UNIQUE" in str(e):
+                raise DuplicateKeyException(*e.args)
+            raise RepositoryException(*e.args)
+
+class SqliteMessageDatRepository(SqliteRepositoryBase, MessageDatStorage):
+
+    def findMessages(self, receptLevel: ReceptLevel, beforeTime: int, count: int, compeNo: str, memberId: str, excludeMyself: bool, afterMessageId: int = 0) -> list:
+        """
+        対象コンペのメッセージを取得する。(条件はMessageDatRepository.findMessagesと同じ)
+        """
+        destSql = self.ifStr(receptLevel == ReceptLevel.All, lambda: "        OR msg.send_type = 2 --コンペ参加者")
+        excludeSql = self.ifStr(excludeMyself, lambda: "    AND msg.member_id <> :memberId --自分を含まない")
+        beforeSql = self.ifStr(beforeTime > 0, lambda: "    AND msg.time < :beforeTime")
+        afterSql = self.ifStr(afterMessageId > 0, lambda: "    AND msg.message_id > :afterMessageId")
+        limitSql = self.ifStr(count > 0, lambda: "    LIMIT :count")
+        sql = """
+SELECT msgex.message_id, msgex.send_type, msgex.compe_no, msgex.member_id, msgex.time, msgex.message, stp.stamp_url AS stamp, stp.stamp_id
+FROM (
+    SELECT msg.*
+    FROM t_message msg
+    WHERE msg.compe_no = :compeNo
+    AND msg.is_delete = 0
+{beforeSql}
+{afterSql}
+    AND (
+        msg.send_type = 1 --ギャラリー含む
+{destSql}
+        OR (
+            msg.send_type = 3 --個人宛
+            AND (
+                msg.dest_member_id = :memberId --自分宛
+                OR msg.member_id = :memberId --送信者が自分
+            )
+        )
+    )
+{excludeSql}
+    ORDER BY msg.time DESC, msg.message_id DESC
+{limitSql}
+) msgex
+LEFT JOIN m_stamp stp ON (
+    stp.is_delete = 0
+    AND msgex.stamp_id IS NOT NULL
+    AND msgex.stamp_id = stp.stamp_id
+)
+ORDER BY msgex.time ASC, msgex.message_id ASC
+""".replace("{destSql}", destSql).replace("{excludeSql}", excludeSql).replace("{beforeSql}", beforeSql).replace("{afterSql}", afterSql).replace("{limitSql}", limitSql)
+
+        messages: list[GetMessagesData] = list()
+        cursor = self.query(sql, { "compeNo": compeNo, "memberId": memberId, "beforeTime": beforeTime, "afterMessageId": afterMessageId, "count": count })
+        for row in cursor:
+            messages.append(GetMessagesData(
+                row["message_id"],
+                row["send_type"],
+                row["compe_no"],
+                row["member_id"],
+                row["time"],
+                row["message"],
+                row["stamp"],
+                row["stamp_id"]
+                ))
+        return messages
+
+    def findActiveCompeNos(self, sinceTime: int) -> list:
+        sql = """
+SELECT DISTINCT msg.compe_no
+FROM t_message msg
+WHERE msg.time >= :sinceTime
+AND msg.is_delete = 0
+"""
+        cursor = self.query(sql, { "sinceTime": sinceTime })
+        return [row["compe_no"] for row in cursor]
+
+    def findLatestMessages(self, compeNo: int, count: int, afterMessageId: int = 0) -> list:
+        afterSql = self.ifStr(afterMessageId > 0, lambda: "    AND msg.message_id > :afterMessageId")
+        sql = """
+SELECT msgex.*
+FROM (
+    SELECT msg.*
+    FROM t_message msg
+    WHERE msg.compe_no = :compeNo
+    AND msg.is_delete = 0
+{afterSql}
+    ORDER BY msg.time DESC, msg.message_id DESC
+    LIMIT :count
+) msgex
+ORDER BY msgex.time ASC, msgex.message_id ASC
+""".replace("{afterSql}", afterSql)
+        messages: list[SendMessageData] = list()
+        cursor = self.query(sql, { "compeNo": compeNo, "count": count, "afterMessageId": afterMessageId })
+        for row in cursor:
+            messages.append(SendMessageData(
+                row["message_id"],
+                row["send_type"],
+                row["compe_no"],
+                row["dest_member_id"],
+                row["member_id"],
+                row["time"],
+                row["message"],
+                row["stamp_id"],
+                bool(row["is_delete"])
+                ))
+        return messages
+
+    def findLastMessageId(self, compeNo: int) -> int:
+        sql = """
+SELECT MAX(msg.message_id) AS message_id
+FROM t_message msg
+WHERE msg.compe_no = :compeNo
+"""
+        cursor = self.query(sql, { "compeNo": compeNo })
+        for row in cursor:
+            return row["message_id"] or 0
+        return 0
+
+    def findMessageId(self, compeNo: int, memberId: str, clientMessageId: str) -> int:
+        sql = """
+SELECT msg.message_id
+FROM t_message msg
+WHERE msg.compe_no = :compeNo
+AND msg.member_id = :memberId
+AND msg.client_message_id = :clientMessageId
+"""
+        cursor = self.query(sql, { "compeNo": compeNo, "memberId": memberId, "clientMessageId": clientMessageId })
+        for row in cursor:
+            return row["message_id"]
+        return None
+
+    def save(self, data: SendMessageData):
+        sql = """
+INSERT INTO t_message (
+    send_type,
+    compe_no,
+    dest_member_id,
+    member_id,
+    time,
+    message,
+    stamp_id,
+    is_delete,
+    client_message_id
+) VALUES (?,?,?,?,?,?,?,?,?);
+"""
+        param = (data.send_type, data.compe_no, data.dest_member_id, data.member_id, data.time, data.message, data.stamp_id, data.is_delete, data.client_message_id)
+        cur = self.execute(sql, param)
+        data.message_id = cur.lastrowid
+        self.router.markWritten(data.member_id)
+
+    def saveAll(self, datas: list):
+        if len(datas) == 0:
+            return
+        sql = """
+INSERT INTO t_message (
+    send_type,
+    compe_no,
+    dest_member_id,
+    member_id,
+    time,
+    message,
+    stamp_id,
+    is_delete,
+    client_message_id
+) VALUES {values};
+""".replace("{values}", ",".join(["(?,?,?,?,?,?,?,?,?)"] * len(datas)))
+        param = list()
+        for data in datas:
+            param.extend((data.send_type, data.compe_no, data.dest_member_id, data.member_id, data.time, data.message, data.stamp_id, data.is_delete, data.client_message_id))
+        cur = self.execute(sql, tuple(param))
+        # 1文の登録中は他の書込みが行われないため、連続したIDとなる。(lastrowidは最終行のID)
+        firstMessageId = cur.lastrowid - len(datas) + 1
+        for index, data in enumerate(datas):
+            data.message_id = firstMessageId + index
+            self.router.markWritten(data.member_id)
+
+class SqliteStampMstRepository(SqliteRepositoryBase, StampMstStorage):
+
+    def findStamps(self) -> list:
+        stamps: list[StampData] = list()
+        sql = """
+SELECT stp.*
+FROM m_stamp stp
+WHERE stp.is_delete = 0
+ORDER BY stp.stamp_id ASC;
+"""
+        cursor = self.query(sql)
+        for row in cursor:
+            stamps.append(StampData(
+                row["stamp_id"],
+                row["stamp_url"]
+                ))
+        return stamps
+
+    def findStamp(self, stampId: int) -> StampData:
+        sql = """
+SELECT stp.*
+FROM m_stamp stp
+WHERE stp.is_delete = 0
+AND stp.stamp_id = :stampId
+"""
+        cursor = self.query(sql, { "stampId": stampId })
+        for row in cursor:
+            return StampData(
+                row["stamp_id"],
+                row["stamp_url"]
+                )
+        return None
@@ -0,0 +1,250 @@
+#coding: UTF-8
+
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from src import log
+from src.config import inifile
+
+currentTrace = contextvars.ContextVar("currentTrace", default=None)
+
+class Span:
+    """
+    処理区間
+    Attributes:
+    name(str):区間名
+    spanId(str):区間ID(16進16桁)
+    parent(Span):親区間
+    start(int):開始時刻(perf_counter_ns)
+    end(int):終了時刻(perf_counter_ns)
+    attributes(dict):付加情報
+    """
+    def __init__(self, name: str, parent):
+        self.name = name
+        self.spanId = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.start = time.perf_counter_ns()
+        self.end = None
+        self.attributes = dict()
+
+    def getPath(self) -> str:
+        if self.parent is None:
+            return self.name
+        return self.parent.getPath() + "/" + self.name
+
+    def getMillis(self) -> float:
+        return ((self.end or time.perf_counter_ns()) - self.start) / 1000000
+
+class Trace:
+    """
+    1リクエストの処理区間の記録
+    Attributes:
+    requestId(str):リクエストID(16進32桁。OTLPのtraceIdとして使用する。)
+    """
+    def __init__(self, name: str):
+        self.requestId = uuid.uuid4().hex
+        self.startTimeNs = time.time_ns()
+        self.root = Span(name, None)
+        self.spans = [self.root]
+        self.current = self.root
+
+    def toUnixNano(self, perfNs: int) -> int:
+        return self.startTimeNs + (perfNs - self.root.start)
+
+class SpanScope:
+    """
+    with文で区間を記録する。
+    """
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        trace = self.trace
+        self.span = Span(self.name, trace.current)
+        trace.spans.append(self.span)
+        trace.current = self.span
+        return self.span
+
+    def __exit__(self, type_, value, traceback):
+        self.span.end = time.perf_counter_ns()
+        if type_ is not None:
+            self.span.attributes["error"] = type_.__name__
+        self.trace.current = self.span.parent
+
+class NoopScope:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, type_, value, traceback):
+        pass
+
+noopScope = NoopScope()
+
+class FileExporter:
+    """
+    トレースをjson形式(1行1トレース)でファイルに出力する。
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, trace: Trace):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(Tracer.toDict(trace), ensure_ascii=False) + "\n")
+
+class OtlpExporter:
+    """
+    トレースをOTLP/HTTP(json)形式でコレクターへ送信する。
+    """
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def export(self, trace: Trace):
+        body = json.dumps(Tracer.toOtlp(trace)).encode("utf-8")
+        request = urllib.request.Request(self.endpoint, data=body, headers={ "Content-Type": "application/json" })
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+class Tracer():
+    """
+    リクエスト単位の処理時間の計測
+    handler、service、repositoryの各処理を区間として記録し、
+    合計時間がslowThresholdMs以上のリクエストのみ(テールサンプリング)ログ出力、エクスポートする。
+    エクスポートはIOLoopを止めないよう別スレッドで行う。
+    """
+    logger = log.getLog(__name__)
+    enabled = inifile.getboolean('trace', 'enabled', fallback=False)
+    slowThresholdMs = inifile.getfloat('trace', 'slowThresholdMs', fallback=200)
+    serviceName = log.moduleName
+    exporters = list()
+    exportQueue = queue.Queue(maxsize=inifile.getint('trace', 'exportQueueSize', fallback=1000))
+    exportThread = None
+
+    @staticmethod
+    def setting():
+        """
+        エクスポーターの設定(起動時に実行する。)
+        """
+        if not Tracer.enabled:
+            return
+        filePath = inifile.get('trace', 'filePath', fallback='')
+        if filePath:
+            Tracer.exporters.append(FileExporter(filePath))
+        otlpEndpoint = inifile.get('trace', 'otlpEndpoint', fallback='')
+        if otlpEndpoint:
+            Tracer.exporters.append(OtlpExporter(otlpEndpoint))
+        if len(Tracer.exporters) > 0 and Tracer.exportThread is None:
+            Tracer.exportThread = threading.Thread(target=Tracer.exportLoop, name="trace-exporter", daemon=True)
+            Tracer.exportThread.start()
+
+    @staticmethod
+    def start(name: str) -> Trace:
+        """
+        トレースを開始する。(無効の場合はNone)
+        """
+        if not Tracer.enabled:
+            return None
+        trace = Trace(name)
+        currentTrace.set(trace)
+        return trace
+
+    @staticmethod
+    def resume(trace: Trace):
+        """
+        遅延実行(待ち行列、別スレッド)の処理で、開始済みのトレースを継続する。
+        """
+        currentTrace.set(trace)
+
+    @staticmethod
+    def current() -> Trace:
+        return currentTrace.get()
+
+    @staticmethod
+    def span(name: str):
+        """
+        現在のトレースに区間を記録する。(トレース中でない場合は何もしない。)
+        """
+        trace = currentTrace.get()
+        if trace is None:
+            return noopScope
+        return SpanScope(trace, name)
+
+    @staticmethod
+    def annotate(key: str, value):
+        trace = currentTrace.get()
+        if trace is not None:
+            trace.current.attributes[key] = value
+
+    @staticmethod
+    def finish(trace: Trace):
+        if trace is None:
+            return
+        currentTrace.set(None)
+        trace.root.end = time.perf_counter_ns()
+        totalMs = trace.root.getMillis()
+        if totalMs < Tracer.slowThresholdMs:
+            return
+        if log.isWarning():
+            stages = ", ".join(span.getPath() + ":" + "{0:.1f}".format(span.getMillis()) + "ms" for span in trace.spans[1:])
+            Tracer.logger.warning("slow request id:" + trace.requestId + ", " + trace.root.name + ":" + "{0:.1f}".format(totalMs) + "ms [" + stages + "]")
+        if len(Tracer.exporters) > 0:
+            try:
+                Tracer.exportQueue.put_nowait(trace)
+            except queue.Full:
+                if log.isWarning():
+                    Tracer.logger.warning("trace export queue full id:" + trace.requestId)
+
+    @staticmethod
+    def exportLoop():
+        while True:
+            trace = Tracer.exportQueue.get()
+            for exporter in Tracer.exporters:
+                try:
+                    exporter.export(trace)
+                except Exception as ex:
+                    if log.isError():
+                        Tracer.logger.error("trace export error(" + exporter.__class__.__name__ + "):" + str(ex))
+
+    @staticmethod
+    def toDict(trace: Trace) -> dict:
+        return {
+            "request_id": trace.requestId,
+            "name": trace.root.name,
+            "start_time": trace.startTimeNs // 1000000,
+            "pid": os.getpid(),
+            "spans": [{
+                "name": span.getPath(),
+                "offset_ms": round((span.start - trace.root.start) / 1000000, 3),
+                "duration_ms": round(span.getMillis(), 3),
+                "attributes": span.attributes
+                } for span in trace.spans]
+            }
+
+    @staticmethod
+    def toOtlp(trace: Trace) -> dict:
+        spans = list()
+        for span in trace.spans:
+            otlpSpan = {
+                "traceId": trace.requestId,
+                "spanId": span.spanId,
+                "name": span.name,
+                "kind": 2 if span.parent is None else 1,
+                "startTimeUnixNano": str(trace.toUnixNano(span.start)),
+                "endTimeUnixNano": str(trace.toUnixNano(span.end or span.start)),
+                "attributes": [{ "key": key, "value": { "stringValue": str(value) } } for key, value in span.attributes.items()]
+                }
+            if span.parent is not None:
+                otlpSpan["parentSpanId"] = span.parent.spanId
+            spans.append(otlpSpan)
+        return {
+            "resourceSpans": [{
+                "resource": { "attributes": [{ "key": "service.name", "value": { "stringValue": Tracer.serviceName } }] },
+                "scopeSpans": [{ "scope": { "name": __name__ }, "spans": spans }]
+                }]
+            }
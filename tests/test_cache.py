@@ -0,0 +1,68 @@
+#coding: UTF-8
+"""
+MessageCache(コンペ毎の直近メッセージ)の読み込み直しの確認
+最新のメッセージIDが変わらない変更(他プロセスでの削除、小さいIDの遅れたコミット)は、windowReloadSeconds経過後に反映すること。
+"""
+import collections
+import pytest
+from src.cache import MessageCache
+from src.enums import ReceptLevel, SendType
+from src.memory_repository import MemoryStore, MemoryMessageDatRepository, MemoryStampMstRepository, open_database
+from src.repository import RepositoryFactory, RepositoryBackend, SendMessageData
+
+COMPE_NO = 1
+
+@pytest.fixture(autouse=True)
+def memoryBackend(monkeypatch):
+    monkeypatch.setattr(MemoryStore, "messageMap", dict())
+    monkeypatch.setattr(MemoryStore, "clientMessageIdMap", dict())
+    monkeypatch.setattr(MemoryStore, "lastMessageId", 0)
+    monkeypatch.setattr(RepositoryFactory, "backend", RepositoryBackend(open_database, MemoryMessageDatRepository, MemoryStampMstRepository))
+    monkeypatch.setattr(MessageCache, "windows", collections.OrderedDict())
+    monkeypatch.setattr(MessageCache, "loading", dict())
+    monkeypatch.setattr(MessageCache, "isInstalled", True)
+    # 参照毎にDBと照合する。
+    monkeypatch.setattr(MessageCache, "refreshSeconds", 0)
+    open_database()
+
+def save(message: str) -> SendMessageData:
+    data = SendMessageData(None, SendType.All.value, COMPE_NO, None, "a", 1000 * (MemoryStore.lastMessageId + 1), message, None, False)
+    MemoryMessageDatRepository().save(data)
+    return data
+
+def findTexts() -> list:
+    return [data.message for data in MessageCache.findMessages(ReceptLevel.All, 0, 0, COMPE_NO, "a", False)]
+
+@pytest.mark.parametrize("reloadSeconds, expected", [(3600, ["first", "second", "third"]), (0, ["first", "third"])])
+def test_reload_drops_deleted_messages(monkeypatch, reloadSeconds, expected):
+    monkeypatch.setattr(MessageCache, "reloadSeconds", reloadSeconds)
+    for message in ("first", "second", "third"):
+        save(message)
+    assert findTexts() == ["first", "second", "third"]
+    # 他プロセスで削除された。(最新のメッセージIDは変わらない。)
+    MemoryStore.messageMap[COMPE_NO][1].is_delete = True
+    assert findTexts() == expected
+
+@pytest.mark.parametrize("reloadSeconds, expected", [(3600, ["second"]), (0, ["first", "second"])])
+def test_reload_adds_late_lower_id(monkeypatch, reloadSeconds, expected):
+    monkeypatch.setattr(MessageCache, "reloadSeconds", reloadSeconds)
+    save("first")
+    save("second")
+    late = MemoryStore.messageMap[COMPE_NO].pop(0)
+    assert findTexts() == ["second"]
+    # 小さいメッセージIDが後からコミットされた。
+    MemoryStore.messageMap[COMPE_NO].insert(0, late)
+    assert findTexts() == expected
+
+def test_reload_keeps_messages_added_while_loading(monkeypatch):
+    monkeypatch.setattr(MessageCache, "reloadSeconds", 0)
+    save("first")
+    assert findTexts() == ["first"]
+    findLatestMessages = MemoryMessageDatRepository.findLatestMessages
+    def findAndSend(self, compeNo, count, afterMessageId=0):
+        datas = findLatestMessages(self, compeNo, count, afterMessageId)
+        # 読込の後、置き換えの前に送信された。
+        MessageCache.add(save("second"))
+        return datas
+    monkeypatch.setattr(MemoryMessageDatRepository, "findLatestMessages", findAndSend)
+    assert findTexts() == ["first", "second"]
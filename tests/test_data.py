@@ -0,0 +1,49 @@
+#coding: UTF-8
+"""
+メッセージ一覧の短縮形式(CompactMessages)の確認
+短縮形式をexpandで戻した結果が、通常形式のjsonとバイト単位で一致すること。
+"""
+import json
+import pytest
+from src.data import CompactMessages
+from src.enums import MethodType, SendType
+from src.manager import SessionInfo
+from src.repository import GetMessagesData, SendMessageData, StampData
+from src.service import PushMessage, createMessagesResult
+
+COMPE_NO = 1
+STAMP = StampData(3, "/stamps/3.png")
+STAMP_URLS = { STAMP.stamp_id: STAMP.stamp_url }
+
+def createDatas() -> list:
+    return [
+        GetMessagesData(10, SendType.All.value, COMPE_NO, "a", 1700000000000, "ナイスショット", None, None),
+        GetMessagesData(11, SendType.Compe.value, COMPE_NO, "b", 1700000000250, None, STAMP.stamp_url, STAMP.stamp_id),
+        GetMessagesData(15, SendType.User.value, COMPE_NO, "c", 1700000060000, "\"quoted\"", None, None),
+        ]
+
+def expandJson(compactJson: str) -> str:
+    return json.dumps(CompactMessages.expand(json.loads(compactJson), STAMP_URLS))
+
+@pytest.mark.parametrize("method", [MethodType.GetMessages, MethodType.GetNewMessages])
+@pytest.mark.parametrize("datas", [createDatas(), createDatas()[:1], []])
+def test_expand_messages_matches_verbose(method, datas):
+    results = list()
+    for compact in (False, True):
+        result = createMessagesResult(SessionInfo(session=None, compact=compact), COMPE_NO, datas)
+        # 送信時(CompeChatHandler.writeMethodResult)と同様に処理タイプを設定する。
+        result.method = method.value
+        results.append(result.toJson())
+    verbose, compact = results
+    assert compact != verbose
+    assert expandJson(compact) == verbose
+
+@pytest.mark.parametrize("stamp", [None, STAMP])
+@pytest.mark.parametrize("message", ["hello", None])
+def test_expand_push_matches_verbose(stamp, message):
+    data = SendMessageData(20, SendType.All.value, COMPE_NO, None, "a", 1700000000000, message, None if stamp is None else stamp.stamp_id, False)
+    push = PushMessage(data, stamp)
+    verbose = push.createResult().toJson()
+    compact = push.createCompactResult().toJson()
+    assert expandJson(compact) == verbose
+    assert ("\"stamp\"" in verbose) == (stamp is not None)
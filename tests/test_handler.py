@@ -0,0 +1,66 @@
+#coding: UTF-8
+"""
+CompeChatHandler(WebSocketの受信処理)の応答順の確認
+全体の流量(AdmissionManager)で遅延実行した要求の後に受信した要求、エラーは、遅延実行した要求の応答の後に送信すること。
+サービス実行スレッド(serviceThreads > 0)、IOLoopのスレッドのいずれで実行する場合も確認する。
+"""
+import asyncio
+import concurrent.futures
+import json
+import pytest
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+from src.enums import MethodType
+from src.handler import CompeChatHandler
+from src.limiter import RateLimiter, AdmissionManager
+from src.manager import SessionManager
+from src.capture import CaptureManager
+
+# Initのみ全体の流量を超えたものとして遅延実行する。
+ADMISSION_WAIT = 0.1
+
+@pytest.fixture(params=["ioloop", "thread"])
+def executor(request, monkeypatch):
+    executor = concurrent.futures.ThreadPoolExecutor(2, "test") if request.param == "thread" else None
+    monkeypatch.setattr(CompeChatHandler, "executor", executor)
+    monkeypatch.setattr(CaptureManager, "enabled", False)
+    monkeypatch.setattr(RateLimiter, "check", lambda session, method, memberId: 0)
+    monkeypatch.setattr(AdmissionManager, "admit", lambda method: ADMISSION_WAIT if method == MethodType.Init else 0)
+    monkeypatch.setattr(AdmissionManager, "release", lambda: None)
+    yield executor
+    if executor is not None:
+        executor.shutdown()
+    SessionManager.idSessionMap.clear()
+    SessionManager.connectionMap.clear()
+    for shard in SessionManager.shards:
+        shard.topicMap.clear()
+
+async def exchange(frames: list) -> list:
+    """
+    フレームを続けて送信し、同数の応答を受信順に返す。
+    """
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/CompeChat", CompeChatHandler)]))
+    server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    try:
+        connection = await tornado.websocket.websocket_connect("ws://127.0.0.1:" + str(port) + "/CompeChat")
+        for frame in frames:
+            await connection.write_message(frame)
+        replies = [json.loads(await asyncio.wait_for(connection.read_message(), 5)) for _ in frames]
+        connection.close()
+        return replies
+    finally:
+        server.stop()
+
+def test_replies_keep_order_under_admission_delay(executor):
+    frames = [
+        json.dumps({ "method": MethodType.Init.value, "init": { "compe_no": 1, "member_id": "a", "recept_level": 1 } }),
+        # init後に実行すればバリデーションエラー、init前に実行すればinit未実行エラーとなる。
+        json.dumps({ "method": MethodType.SendMessage.value, "send_message": { "send_type": 1 } }),
+        "{bad",
+        ]
+    replies = asyncio.run(exchange(frames))
+    assert [(reply["method"], reply["status"]) for reply in replies] == [(1, 0), (3, 90100), (0, 90001)]
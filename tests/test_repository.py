@@ -0,0 +1,121 @@
+#coding: UTF-8
+"""
+リポジトリのバックエンド(memory、sqlite、mysql)が同じ結果を返すことの確認
+mysqlは[db]の接続先に接続できる場合のみ実行する。(登録したデータは終了時にロールバックする。)
+"""
+import pytest
+from src import repository, memory_repository, sqlite_repository
+from src.enums import ReceptLevel, SendType
+from src.repository import DuplicateKeyException, RepositoryException, SendMessageData
+from src.memory_repository import MemoryStore, MemoryMessageDatRepository
+from src.sqlite_repository import SqliteRepositoryBase, SqliteMessageDatRepository
+
+# 既存データと重複しないコンペ番号(mysql)
+COMPE_NO = 990000001
+OTHER_COMPE_NO = 990000002
+
+@pytest.fixture(params=["memory", "sqlite", "mysql"])
+def messageDat(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        monkeypatch.setattr(MemoryStore, "messageMap", dict())
+        monkeypatch.setattr(MemoryStore, "clientMessageIdMap", dict())
+        monkeypatch.setattr(MemoryStore, "lastMessageId", 0)
+        memory_repository.open_database()
+        storage = MemoryMessageDatRepository()
+    elif request.param == "sqlite":
+        path = str(tmp_path / "chat.db")
+        sqlite_repository.open_database(path)
+        monkeypatch.setattr(SqliteRepositoryBase, "path", path)
+        storage = SqliteMessageDatRepository()
+    else:
+        if repository.mysql is None:
+            pytest.skip("mysql-connector-pythonがインストールされていません。")
+        try:
+            storage = repository.MessageDatRepository()
+            storage.findLastMessageId(COMPE_NO)
+        except RepositoryException as ex:
+            pytest.skip("MySQLに接続できません:" + str(ex))
+    yield storage
+    if request.param == "mysql":
+        # 登録したデータを残さない。
+        storage.isComplete = False
+    storage.close()
+
+def createData(sendType: SendType, memberId: str, time: int, message: str, destMemberId: str = None, compeNo: int = COMPE_NO, clientMessageId: str = None) -> SendMessageData:
+    return SendMessageData(None, sendType.value, compeNo, destMemberId, memberId, time, message, None, False, clientMessageId)
+
+def saveSamples(messageDat) -> list:
+    datas = [
+        createData(SendType.All, "a", 1000, "all from a"),
+        createData(SendType.Compe, "b", 2000, "compe from b"),
+        createData(SendType.User, "b", 3000, "b to a", "a"),
+        createData(SendType.User, "b", 4000, "b to c", "c"),
+        createData(SendType.All, "c", 5000, "all from c"),
+        ]
+    for data in datas:
+        messageDat.save(data)
+    return datas
+
+def findTexts(messageDat, receptLevel: ReceptLevel, beforeTime: int = 0, count: int = 0, memberId: str = "a", excludeMyself: bool = False, afterMessageId: int = 0) -> list:
+    return [data.message for data in messageDat.findMessages(receptLevel, beforeTime, count, COMPE_NO, memberId, excludeMyself, afterMessageId)]
+
+def test_save_assigns_increasing_ids(messageDat):
+    datas = saveSamples(messageDat)
+    messageIds = [data.message_id for data in datas]
+    assert all(messageId is not None for messageId in messageIds)
+    assert messageIds == sorted(set(messageIds))
+    assert messageDat.findLastMessageId(COMPE_NO) == messageIds[-1]
+    assert messageDat.findLastMessageId(OTHER_COMPE_NO) == 0
+
+def test_save_all_assigns_stored_ids(messageDat):
+    messageDat.save(createData(SendType.All, "a", 1000, "before"))
+    datas = [createData(SendType.All, "admin", 2000, "announce", compeNo=compeNo) for compeNo in (COMPE_NO, OTHER_COMPE_NO)]
+    messageDat.saveAll(datas)
+    for data in datas:
+        stored = messageDat.findLatestMessages(data.compe_no, 1)
+        assert [(it.message_id, it.message) for it in stored] == [(data.message_id, "announce")]
+    messageDat.saveAll([])
+
+def test_find_messages_by_recept_level(messageDat):
+    saveSamples(messageDat)
+    assert findTexts(messageDat, ReceptLevel.All) == ["all from a", "compe from b", "b to a", "all from c"]
+    assert findTexts(messageDat, ReceptLevel.Gallery) == ["all from a", "b to a", "all from c"]
+    # 個人宛は送信者も受信対象
+    assert findTexts(messageDat, ReceptLevel.Gallery, memberId="b") == ["all from a", "b to a", "b to c", "all from c"]
+
+def test_find_messages_conditions(messageDat):
+    datas = saveSamples(messageDat)
+    assert findTexts(messageDat, ReceptLevel.All, excludeMyself=True) == ["compe from b", "b to a", "all from c"]
+    assert findTexts(messageDat, ReceptLevel.All, beforeTime=3000) == ["all from a", "compe from b"]
+    assert findTexts(messageDat, ReceptLevel.All, count=2) == ["b to a", "all from c"]
+    assert findTexts(messageDat, ReceptLevel.All, beforeTime=5000, count=2) == ["compe from b", "b to a"]
+    assert findTexts(messageDat, ReceptLevel.All, afterMessageId=datas[1].message_id) == ["b to a", "all from c"]
+    assert findTexts(messageDat, ReceptLevel.All, afterMessageId=datas[-1].message_id) == []
+
+def test_find_latest_messages(messageDat):
+    datas = saveSamples(messageDat)
+    assert [data.message for data in messageDat.findLatestMessages(COMPE_NO, 2)] == ["b to c", "all from c"]
+    latest = messageDat.findLatestMessages(COMPE_NO, 10, datas[2].message_id)
+    assert [data.message_id for data in latest] == [data.message_id for data in datas[3:]]
+    assert latest[0].dest_member_id == "c"
+
+def test_client_message_id(messageDat):
+    data = createData(SendType.All, "a", 1000, "first", clientMessageId="client-1")
+    messageDat.save(data)
+    assert messageDat.findMessageId(COMPE_NO, "a", "client-1") == data.message_id
+    assert messageDat.findMessageId(COMPE_NO, "b", "client-1") is None
+    with pytest.raises(DuplicateKeyException):
+        messageDat.save(createData(SendType.All, "a", 2000, "retry", clientMessageId="client-1"))
+    # 他の会員、他のコンペ、未指定(None)は重複としない。
+    messageDat.save(createData(SendType.All, "b", 3000, "other member", clientMessageId="client-1"))
+    messageDat.save(createData(SendType.All, "a", 3000, "other compe", compeNo=OTHER_COMPE_NO, clientMessageId="client-1"))
+    messageDat.save(createData(SendType.All, "a", 4000, "no id 1"))
+    messageDat.save(createData(SendType.All, "a", 5000, "no id 2"))
+    assert findTexts(messageDat, ReceptLevel.All) == ["first", "other member", "no id 1", "no id 2"]
+
+def test_find_active_compe_nos(messageDat):
+    messageDat.save(createData(SendType.All, "a", 1000, "old", compeNo=OTHER_COMPE_NO))
+    messageDat.save(createData(SendType.All, "a", 9000000000000, "recent"))
+    compeNos = messageDat.findActiveCompeNos(8000000000000)
+    assert COMPE_NO in compeNos
+    assert OTHER_COMPE_NO not in compeNos
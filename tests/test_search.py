@@ -0,0 +1,70 @@
+#coding: UTF-8
+"""
+メッセージ検索の索引(CompeIndex、SearchIndexManager)の確認
+索引はメッセージIDの小さいメッセージから除外し、他プロセスで削除されたメッセージはrebuildSeconds経過後に除くこと。
+"""
+import collections
+import pytest
+from src.enums import ReceptLevel, SendType
+from src.memory_repository import MemoryStore, MemoryMessageDatRepository, MemoryStampMstRepository, open_database
+from src.repository import RepositoryFactory, RepositoryBackend, SendMessageData
+from src.search import CompeIndex, SearchIndexManager
+
+COMPE_NO = 1
+
+@pytest.fixture
+def memoryBackend(monkeypatch):
+    monkeypatch.setattr(MemoryStore, "messageMap", dict())
+    monkeypatch.setattr(MemoryStore, "clientMessageIdMap", dict())
+    monkeypatch.setattr(MemoryStore, "lastMessageId", 0)
+    monkeypatch.setattr(RepositoryFactory, "backend", RepositoryBackend(open_database, MemoryMessageDatRepository, MemoryStampMstRepository))
+    monkeypatch.setattr(SearchIndexManager, "indexes", collections.OrderedDict())
+    monkeypatch.setattr(SearchIndexManager, "pending", dict())
+    # 検索毎にDBから読み込む。
+    monkeypatch.setattr(SearchIndexManager, "refreshSeconds", 0)
+    open_database()
+
+def createData(messageId: int, message: str, time: int = None) -> SendMessageData:
+    return SendMessageData(messageId, SendType.All.value, COMPE_NO, None, "a", 1000 * messageId if time is None else time, message, None, False)
+
+def save(message: str) -> SendMessageData:
+    data = createData(None, message, 1000 * (MemoryStore.lastMessageId + 1))
+    MemoryMessageDatRepository().save(data)
+    return data
+
+def searchTexts(keyword: str) -> list:
+    return [data.message for data in SearchIndexManager.search(COMPE_NO, keyword, None, ReceptLevel.All, "a", 0, 10)]
+
+def test_evicts_lowest_message_id():
+    index = CompeIndex(2)
+    # 小さいIDの遅れたコミットを後から追加する。
+    for messageId in (2, 3, 1):
+        index.add(createData(messageId, "golf " + str(messageId)))
+    assert sorted(index.datas) == [2, 3]
+    index.add(createData(4, "golf 4"))
+    assert sorted(index.datas) == [3, 4]
+    assert index.tokenMap["golf"] == {3, 4}
+    assert [data.message_id for data in index.search("golf", None, ReceptLevel.All, "a", 0, 10)] == [4, 3]
+
+@pytest.mark.parametrize("rebuildSeconds, expected", [(3600, ["golf third", "golf second", "golf first"]), (0, ["golf third", "golf first"])])
+def test_rebuild_drops_deleted_messages(memoryBackend, monkeypatch, rebuildSeconds, expected):
+    monkeypatch.setattr(SearchIndexManager, "rebuildSeconds", rebuildSeconds)
+    for message in ("golf first", "golf second", "golf third"):
+        SearchIndexManager.add(save(message))
+    assert searchTexts("golf") == ["golf third", "golf second", "golf first"]
+    # 他プロセスで削除された。(最新のメッセージIDは変わらない。)
+    MemoryStore.messageMap[COMPE_NO][1].is_delete = True
+    assert searchTexts("golf") == expected
+
+def test_rebuild_keeps_messages_added_while_building(memoryBackend, monkeypatch):
+    monkeypatch.setattr(SearchIndexManager, "rebuildSeconds", 0)
+    save("golf first")
+    assert searchTexts("golf") == ["golf first"]
+    findLatestMessages = MemoryMessageDatRepository.findLatestMessages
+    def findAndSend(self, compeNo, count, afterMessageId=0):
+        datas = findLatestMessages(self, compeNo, count, afterMessageId)
+        # 読込の後、置き換えの前に送信された。
+        SearchIndexManager.add(save("golf second"))
+        return datas
+    monkeypatch.setattr(MemoryMessageDatRepository, "findLatestMessages", findAndSend)
+    assert searchTexts("golf") == ["golf second", "golf first"]
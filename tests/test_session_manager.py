@@ -0,0 +1,127 @@
+#coding: UTF-8
+"""
+SessionManager(コンペ番号で分割したセッション管理)の並行実行の確認
+サービス実行スレッド(serviceThreads > 0)と同様に、init・送信・切断を複数スレッドで同時に実行する。
+"""
+import concurrent.futures
+import random
+import threading
+import pytest
+from src.enums import ReceptLevel
+from src.manager import SessionManager, SessionInfo
+
+class FakeSession:
+    """
+    WebSocketHandlerの代わり(SessionManagerが参照する項目のみ)
+    """
+    def __init__(self, sessionId: str):
+        self.id = sessionId
+        self.closed = False
+        self.received = 0
+
+    def close(self):
+        # CompeChatHandler.on_closeと同じ順序で削除する。
+        self.closed = True
+        SessionManager.removeSession(self)
+        SessionManager.removeConnection(self)
+
+@pytest.fixture(autouse=True)
+def clearSessions():
+    yield
+    SessionManager.idSessionMap.clear()
+    SessionManager.connectionMap.clear()
+    for shard in SessionManager.shards:
+        shard.topicMap.clear()
+
+def createInfo(session: FakeSession, compeNo: int, receptLevel: ReceptLevel = ReceptLevel.All) -> SessionInfo:
+    return SessionInfo(session=session, compeNo=compeNo, memberId="member" + str(random.randint(1, 5)), receptLevel=receptLevel)
+
+def countTopicSessions() -> int:
+    return sum(len(topic.allSessionMap) for shard in SessionManager.shards for topic in shard.topicMap.values())
+
+def test_add_session_after_close_is_skipped():
+    session = FakeSession("closed")
+    SessionManager.addConnection(session)
+    session.close()
+    SessionManager.addSession(createInfo(session, 1))
+    assert SessionManager.countSessions() == 0
+    assert SessionManager.getSessionInfos(1) == ()
+
+def test_close_during_init_leaves_no_session(monkeypatch):
+    session = FakeSession("racing")
+    info = createInfo(session, 1)
+    originalSubscribe = SessionManager.subscribe
+
+    def subscribeAndClose(sessionInfo, compeNo, receptLevel):
+        # 登録処理の途中で切断された場合
+        session.close()
+        originalSubscribe(sessionInfo, compeNo, receptLevel)
+
+    monkeypatch.setattr(SessionManager, "subscribe", subscribeAndClose)
+    SessionManager.addSession(info)
+    assert SessionManager.countSessions() == 0
+    assert countTopicSessions() == 0
+
+def test_parallel_init_send_close():
+    compeNos = list(range(1, 9))
+    sessionCount = 2000
+    errors = list()
+
+    def run(index: int):
+        session = FakeSession("session" + str(index))
+        SessionManager.addConnection(session)
+        compeNo = random.choice(compeNos)
+        info = createInfo(session, compeNo, random.choice(list(ReceptLevel)))
+
+        def init():
+            SessionManager.addSession(info)
+            SessionManager.subscribe(info, random.choice(compeNos), ReceptLevel.All)
+
+        def send():
+            # 送信中は取得した一覧のみ参照する。(ロックを保持しない)
+            for target in SessionManager.getSessionInfos(compeNo):
+                target.session.received += 1
+            for target in SessionManager.getParticipantSessionInfos(compeNo):
+                target.session.received += 1
+            for target in SessionManager.getMemberSessionInfos(compeNo, info.memberId):
+                target.session.received += 1
+
+        threads = [threading.Thread(target=it) for it in (init, send, session.close)]
+        random.shuffle(threads)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        for future in [executor.submit(run, index) for index in range(sessionCount)]:
+            try:
+                future.result()
+            except Exception as ex:
+                errors.append(ex)
+    assert errors == []
+    # 切断済みのセッションは、登録・切断の順序に関わらず残らない。
+    assert SessionManager.countSessions() == 0
+    assert SessionManager.countConnections() == 0
+    assert countTopicSessions() == 0
+    for shard in SessionManager.shards:
+        assert len(shard.topicMap) == 0
+
+def test_parallel_subscribe_keeps_snapshots_consistent():
+    sessions = [FakeSession("live" + str(index)) for index in range(200)]
+    infos = [createInfo(session, 1) for session in sessions]
+    for info in infos:
+        SessionManager.addSession(info)
+
+    def churn(info: SessionInfo):
+        for compeNo in range(2, 12):
+            SessionManager.subscribe(info, compeNo, ReceptLevel.Gallery)
+            SessionManager.getSessionInfos(compeNo)
+            SessionManager.unsubscribe(info, compeNo)
+
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        list(executor.map(churn, infos))
+    assert len(SessionManager.getSessionInfos(1)) == len(sessions)
+    assert all(list(info.subscriptions.keys()) == [1] for info in infos)
+    for compeNo in range(2, 12):
+        assert SessionManager.getSessionInfos(compeNo) == ()
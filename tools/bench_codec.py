@@ -0,0 +1,42 @@
+#coding: UTF-8
+"""
+送受信形式(json、msgpack、cbor)の変換時間とサイズの比較
+GetMessages 100件相当の返却値を変換する。
+実行: python -m tools.bench_codec [件数] [繰り返し回数]
+"""
+import sys
+import timeit
+from src.data import ServerResult, Serializable
+from src.enums import MethodType, ResultStatus
+from src.codec import Codecs
+
+def createResult(count: int) -> ServerResult:
+    result = ServerResult.fromAll(MethodType.GetMessages, ResultStatus.Success)
+    result.messages = list()
+    for i in range(count):
+        message = Serializable()
+        message.send_type = 1 + i % 3
+        message.message_id = 100000 + i
+        message.compe_no = 12345
+        message.member_id = "member" + str(i % 20)
+        message.time = 1560000000000 + i * 15000
+        message.message = "ナイスショット！ {0}番ホール".format(i % 18 + 1) if i % 4 else None
+        message.stamp = "https://example.com/static/stamps/{0}.png".format(i % 41 + 1) if not i % 4 else None
+        result.messages.append(message)
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    result = createResult(count)
+    print("messages:{0}, number:{1}".format(count, number))
+    print("{0:<8} {1:>10} {2:>12} {3:>12}".format("codec", "bytes", "encode(us)", "decode(us)"))
+    for codec in Codecs.codecMap.values():
+        payload = codec.encode(result)
+        size = len(payload.encode("utf-8")) if isinstance(payload, str) else len(payload)
+        encodeTime = timeit.timeit(lambda: codec.encode(result), number=number) / number * 1000000
+        decodeTime = timeit.timeit(lambda: codec.decode(payload), number=number) / number * 1000000
+        print("{0:<8} {1:>10} {2:>12.1f} {3:>12.1f}".format(codec.name, size, encodeTime, decodeTime))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#coding: UTF-8
+"""
+記録した受信フレーム([capture])の再生
+記録時と同じ間隔(speed倍速)でセッションを接続し、フレームを送信する。
+処理タイプ毎の応答時間と、他セッションへの配信遅延(メッセージの時刻から受信までの時間)を集計する。
+DBを変更しないよう、再生先のサーバーはconfig.iniの[db] backendをmemoryあるいはsqliteにして起動すること。
+実行: python -m tools.replay 記録ファイル [倍速] [接続先URL]
+"""
+import base64
+import collections
+import gzip
+import json
+import sys
+import time
+import tornado.ioloop
+import tornado.gen
+import tornado.websocket
+from src.enums import MethodType
+from src.codec import Codecs
+
+def readEvents(path: str) -> dict:
+    """
+    記録ファイルを読み込み、セッション番号毎のイベント(時刻の昇順)を返す。
+    """
+    sessions = collections.OrderedDict()
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                sessions.setdefault(event["s"], list()).append(event)
+        except EOFError:
+            # 記録中の圧縮ファイルは終端がないため、書き出し済みの分のみ読み込む。
+            pass
+    return sessions
+
+def percentile(values: list, rate: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * rate))]
+
+class ReplayStats:
+    """
+    集計結果
+    Attributes:
+    latencies(dict(str, list(float))):処理タイプ毎の応答時間(ミリ秒)
+    errors(dict(str, int)):処理タイプ毎のエラー(status != 0)件数
+    lags(list(float)):他セッションへの配信遅延(ミリ秒)
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+        self.lags = list()
+        self.sessions = 0
+        self.failedSessions = 0
+
+    def report(self, elapsed: float):
+        print("sessions:{0}, failed:{1}, time(s):{2:.1f}".format(self.sessions, self.failedSessions, elapsed))
+        print("{0:<16} {1:>7} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}".format("method", "count", "errors", "p50(ms)", "p95(ms)", "p99(ms)", "max(ms)"))
+        for name, values in sorted(self.latencies.items()):
+            self.printRow(name, values, self.errors[name])
+        self.printRow("fanout", self.lags, 0)
+
+    def printRow(self, name: str, values: list, errors: int):
+        print("{0:<16} {1:>7} {2:>7} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f}".format(
+                name, len(values), errors, percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99), max(values, default=0)))
+
+class ReplaySession:
+    """
+    1セッションの再生
+    応答は同一セッション内で受信順に返却されるため、処理タイプ毎に送信時刻を順に対応付ける。
+    処理タイプが不正な要求の応答は処理タイプ0となるため、unknownとして対応付ける。
+    """
+    # サーバーからの通知(要求の応答ではないため対応付けない。)
+    pushMethods = (MethodType.Reconnect, MethodType.GetMessagesFromSend)
+    def __init__(self, events: list, stats: ReplayStats, url: str, speed: float, startTime: float):
+        self.events = events
+        self.stats = stats
+        self.url = url
+        self.speed = speed
+        self.startTime = startTime
+        self.codec = Codecs.default
+        self.pending = collections.defaultdict(collections.deque)
+
+    async def sleepUntil(self, eventTime: float):
+        wait = self.startTime + eventTime / 1000 / self.speed - time.monotonic()
+        if wait > 0:
+            await tornado.gen.sleep(wait)
+
+    async def run(self):
+        connection = None
+        try:
+            for event in self.events:
+                await self.sleepUntil(event["t"])
+                if event["e"] == "open":
+                    self.codec = Codecs.codecMap.get(event.get("c"), Codecs.default)
+                    subprotocols = None if self.codec is Codecs.default else [self.codec.name]
+                    connection = await tornado.websocket.websocket_connect(self.url, subprotocols=subprotocols, on_message_callback=self.onMessage)
+                    self.stats.sessions += 1
+                elif event["e"] == "msg" and connection is not None:
+                    payload = base64.b64decode(event["b"]) if "b" in event else event["p"]
+                    self.pending[self.getMethodName(payload)].append(time.monotonic())
+                    connection.write_message(payload, binary=isinstance(payload, bytes))
+                elif event["e"] == "close" and connection is not None:
+                    # 送信済みの要求の応答を待ってから切断する。
+                    await self.waitPending()
+                    connection.close()
+                    connection = None
+        except Exception as ex:
+            self.stats.failedSessions += 1
+            print("session error:" + str(ex), file=sys.stderr)
+        finally:
+            if connection is not None:
+                await self.waitPending()
+                connection.close()
+
+    async def waitPending(self, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while any(len(it) > 0 for it in self.pending.values()) and time.monotonic() < deadline:
+            await tornado.gen.sleep(0.01)
+
+    def getMethodName(self, payload) -> str:
+        try:
+            method = MethodType.parse(self.codec.decode(payload).get("method"))
+        except Exception:
+            method = None
+        # 通知専用の処理タイプを送信した場合は、処理タイプ不正の応答となる。
+        return "unknown" if method is None or method in ReplaySession.pushMethods else method.name
+
+    def onMessage(self, message):
+        if message is None:
+            return
+        now = time.monotonic()
+        result = self.codec.decode(message)
+        method = MethodType.parse(result.get("method"))
+        if method == MethodType.GetMessagesFromSend:
+            # 他セッション(自分を含む)からの配信
+            header = result.get("header")
+            for message in result.get("messages") or []:
+                messageTime = header["base_time"] if header is not None else message["time"]
+                self.stats.lags.append(time.time() * 1000 - messageTime)
+            return
+        if method in ReplaySession.pushMethods:
+            # 停止処理中の再接続要求など
+            return
+        name = "unknown" if method is None else method.name
+        queue = self.pending.get(name)
+        if not queue:
+            # 対応する要求がない応答は集計しない。
+            return
+        sent = queue.popleft()
+        self.stats.latencies[name].append((now - sent) * 1000)
+        if result.get("status") != 0:
+            self.stats.errors[name] += 1
+
+async def replay(path: str, speed: float, url: str):
+    sessions = readEvents(path)
+    stats = ReplayStats()
+    startTime = time.monotonic()
+    await tornado.gen.multi([ReplaySession(events, stats, url, speed, startTime).run() for events in sessions.values()])
+    stats.report(time.monotonic() - startTime)
+
+def main():
+    if len(sys.argv) < 2:
+        print("python -m tools.replay 記録ファイル [倍速] [接続先URL]")
+        return
+    path = sys.argv[1]
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    url = sys.argv[3] if len(sys.argv) > 3 else "ws://localhost:8080/CompeChat"
+    tornado.ioloop.IOLoop.current().run_sync(lambda: replay(path, speed, url))
+
+if __name__ == '__main__':
+    main()